@@ -1,311 +1,271 @@
-import re 
+import re
+import sys
+import mmap
+import struct
 import logging
+import argparse
 import os
 
 
+_value = re.compile(r'^[+-]?(0b|0x|0o)?[abcdef0-9]+$', re.IGNORECASE)
+_bases = {'0b': 2, '0o': 8, '0x': 16}
+_word = re.compile(r'\w')
+_line_tag = re.compile(r'[\w]+?:')
+_tag = re.compile(r'^[A-Za-z][\w]*:$')
+_data = re.compile(r'(.[\w]+?)[\s]+([\S].*)')
+_regs = {f"x{i}": i for i in range(32)}
+_pack_word = struct.Struct("<I").pack_into
+
+logger = logging.getLogger("asm")
+errors = 0                      # errors logged so far: a pass of assemble() that logs one fails
+
+
+def _error(msg:str):
+    global errors
+    errors += 1
+    logger.info(msg)
+
+
+def split_ops(body:str, seps:str=',')->list:
+    """ re.split(r'[\s' + seps + ']+', body) without a regex, body has no surrounding spaces """
+    parts = body
+    for c in seps:
+        parts = parts.replace(c, ' ')
+    parts = parts.split()
+    if body[0] in seps:
+        parts.insert(0, '')
+    if body[-1] in seps:
+        parts.append('')
+    return parts
+
 # 14, -2, 0xae, -0x34, 0b1110, -0b101, ...
 def str2int(a:str)->int:
-    
-    check = re.match(r'^[+-]?(0b|0x|0o)?[abcdef0-9]+$',a,re.IGNORECASE)
+    if a.isdecimal() and a.isascii():
+        return int(a)
+    check = _value.match(a)
     if not check:
-        logger.info('[error] invaild value: {}'.format(a))
+        _error('[error] invaild value: {}'.format(a))
         return 0
-    base = 10
     base_check = check.groups()[0]
-    if base_check in ['0b','0B']:
-        base = 2
-    elif base_check in ['0o','0O']:
-        base = 8
-    elif base_check in ['0x','0X']:
-        base = 16 
+    base = _bases[base_check.lower()] if base_check else 10
     try:
         return int(a,base)
-    except:
-        logger.info('[error] invaild value: {}'.format(a))
+    except ValueError:
+        _error('[error] invaild value: {}'.format(a))
         return 0
-"""
-convert signed integer to 2's Complement
-"""
-def int2bin(a:int, length:int)->str:
-    mask = (1 << length) - 1
-    mask_ = (1 << (length-1)) - 1
-    overflow = a > mask_ or a < -(mask_ + 1)
-    ret = bin(a & mask)[2:]
-    return '0'*(length-len(ret))+ret, overflow
-"""
-convert 0000000111 to bytes b'\x07\x00\x00\x00'
-"""
-def str2bytes(a:str):
-    return int(a,2).to_bytes(4,byteorder='little')
+
+
+def source_lines(lines):
+    """ strip comments and blank lines, split "tag: inst": yields ('xxx', line_number) """
+    for N, line in enumerate(lines):
+        line = line.partition('#')[0].strip()
+        if not _word.search(line):
+            continue
+        tag = ':' in line and _line_tag.match(line)
+        if tag:
+            idx = tag.span()[1]
+            yield line[:idx], N
+            line = line[idx:].strip()
+            if not _word.search(line):
+                continue
+        yield line, N
+
+def _is_tag(line:str)->bool:
+    return line[-1] == ':' and _tag.match(line) is not None
+
+def str2ints(values:list)->list:
+    """ [str2int(i) for i in values], in one go when they are all plain decimals """
+    joined = ''.join(values)
+    if joined.isascii() and '_' not in joined:
+        try:
+            return list(map(int, values))
+        except ValueError:
+            pass
+    return [str2int(i) for i in values]
+
 
 class ASM:
+    """ assemble a source held in memory, keeps every unit: see assemble() for files """
     def __init__(self, code:str):
-        self.lines = []    # [('xxx', line_number)]
-        N = -1
-        for line in code.split('\n'):
-            N += 1
-            line = re.split(r'#', line)[0].strip()
-            if not re.search(r'\w', line):
-                continue
-            tag = re.match(r'[\w]+?:',line)
-            if tag:
-                idx = tag.span()[1]
-                self.lines.append((line[:idx],N))
-                line = line[idx:].strip()
-                if not re.search(r'\w', line):
-                    continue
-            self.lines.append((line,N))
-        logger.info("--------- precheck done ---------")
-        for i in self.lines:
-            logger.info(i)
-        logger.info("--------- pseduo ---------")
+        self.lines = list(source_lines(code.split('\n')))    # [('xxx', line_number)]
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("--------- precheck done ---------")
+            for i in self.lines:
+                logger.debug(i)
+            logger.debug("--------- pseduo ---------")
         self.pseduo()
-        logger.info("--------- pseduo done ---------")
+        if debug:
+            logger.debug("--------- pseduo done ---------")
+            for i in self.units:
+                i.show()
+        size = max([self.mem_addr] + [u.next_mem_addr for u in self.units])
+        self.image = bytearray(size)            # the whole memory image, units write into it
         for i in self.units:
-            i.show()
-        for i in self.units:
-            i.decode(self.tags)
-        logger.info("--------- decode done ---------")
-        for i in self.units:
-            i.show_bytes()
-        
+            i.decode(self.tags, self.image)
+        if debug:
+            logger.debug("--------- decode done ---------")
+            for i in self.units:
+                i.show_bytes()
+
     def pseduo(self):
         self.tags = {}
         self.mem_addr = 0
         self.units = []
-        
+
         for line, N in self.lines:
-            if re.match(r'^[A-Za-z][\w]*:$',line):
+            if _is_tag(line):
                 tag_name = line[:-1]
-                if tag_name in self.tags.keys():
-                    logger.info("[error] tags used twice!")
+                if tag_name in self.tags:
+                    _error("[error] tags used twice!")
                     return
                 self.tags[tag_name] = self.mem_addr
             else:
                 self.units.append(Unit(line, N, self.mem_addr))
                 self.mem_addr = self.units[-1].next_mem_addr
-        logger.info('found tags: {}'.format(self.tags))
-        
+        logger.debug('found tags: {}'.format(self.tags))
+
 class Unit:
-    
-    vaild_pseduo = ['.word','.dword','.addr', '.string', '.byte']
-    
+
+    vaild_pseduo = ['.word','.dword','.addr', '.string', '.byte', '.space', '.zero', '.globl']
+
     def __init__(self, content, N, mem_addr):
-        self.mem_addr = mem_addr 
+        self.mem_addr = mem_addr
         self.next_mem_addr = mem_addr
-        self.content = content 
+        self.content = content
         self.line_num = N
         self.binary = bytes()
+        self.word = None        # encoded instruction
         if content[0] == '.':
-            self.types = 'data' 
+            self.types = 'data'
             self.handle_data()
         else:  # is instruction
             self.mem_addr = (self.mem_addr + 3) >> 2 << 2  # aligned 4 bytes
             self.types = 'instruction'
             self.next_mem_addr = self.mem_addr + 4
-            
+
     def handle_data(self):
-        r = re.match(r'(.[\w]+?)[\s]+([\S].*)', self.content)
+        r = _data.match(self.content)
         if not r or len(r.groups()) != 2:
-            logger.info(f"[error:{self.line_num}] invalid line: {self.content}")
+            _error(f"[error:{self.line_num}] invalid line: {self.content}")
             return
         name = r.groups()[0]
-        values = re.split(r'[\s,]+',r.groups()[1])
+        values = split_ops(r.groups()[1])
         if not name in self.vaild_pseduo:
-            logger.info(f'[error:{self.line_num}] invaild pesduo: {name}')
+            _error(f'[error:{self.line_num}] invaild pesduo: {name}')
             return
         if name == '.addr':
             self.next_mem_addr = str2int(values[0])
             if self.next_mem_addr < self.mem_addr:
-                logger.info(f'[error:{self.line_num}] address too small: {self.next_mem_addr}')
-                return 
-            self.binary = b'\x00' * (self.next_mem_addr - self.mem_addr) 
+                _error(f'[error:{self.line_num}] address too small: {self.next_mem_addr}')
+                return
+            # no padding bytes, the image is zero-filled
+        elif name in ['.space', '.zero']:           # reserve n zero bytes, same as .addr
+            n = str2int(values[0])
+            if n < 0:
+                _error(f'[error:{self.line_num}] negative size: {n}')
+                return
+            self.next_mem_addr = self.mem_addr + n
+        elif name == '.globl':                      # tags other objects may use, see assemble_object()
+            pass
         elif name == '.byte':
-            bins = [ (str2int(i)&0xff).to_bytes(length=1,byteorder='little',signed=False)  for i in values]
-            self.next_mem_addr = self.mem_addr + len(bins)
-            for i in bins:
-                self.binary += i
+            self.binary = bytes([i & 0xff for i in str2ints(values)])
+            self.next_mem_addr = self.mem_addr + len(self.binary)
         elif name == '.word':
-            bins = [ (str2int(i)&0xffffffff).to_bytes(length=4,byteorder='little',signed=False)  for i in values]
+            values = [i & 0xffffffff for i in str2ints(values)]
+            self.binary = struct.pack(f"<{len(values)}I", *values)
             self.mem_addr = (self.mem_addr + 3) >> 2 << 2       # aligned 4 bytes
-            self.next_mem_addr = self.mem_addr + len(bins) * 4
-            for i in bins:
-                self.binary += i
+            self.next_mem_addr = self.mem_addr + len(self.binary)
         elif name == '.dword':
-            bins = [ (str2int(i)&0xffffffffffffffff).to_bytes(length=8,byteorder='little',signed=False)  for i in values]
+            values = [i & 0xffffffffffffffff for i in str2ints(values)]
+            self.binary = struct.pack(f"<{len(values)}Q", *values)
             self.mem_addr = (self.mem_addr + 3) >> 2 << 2       # aligned 4 bytes
-            self.next_mem_addr = self.mem_addr + len(bins) * 8
-            for i in bins:
-                self.binary += i     
+            self.next_mem_addr = self.mem_addr + len(self.binary)
         elif name == '.string':        # unicode
             str_converted = values[0][1:-1].encode().decode('unicode_escape')
-            bins = [ (ord(i)&0xffffffff).to_bytes(length=4,byteorder='little',signed=False)  for i in str_converted]
-            bins.append(b'\x00'*4)     # endpoint
+            values = [ord(i) & 0xffffffff for i in str_converted] + [0]   # endpoint
+            self.binary = struct.pack(f"<{len(values)}I", *values)
             self.mem_addr = (self.mem_addr + 3) >> 2 << 2       # aligned 4 bytes
-            self.next_mem_addr = self.mem_addr + len(bins) * 4
-            for i in bins:
-                self.binary += i            
-        logger.info(f"[line:{self.line_num}\tmem:{self.mem_addr}] {name}:{self.binary.hex()}")
-            
-    
+            self.next_mem_addr = self.mem_addr + len(self.binary)
+        logger.debug(f"[line:{self.line_num}\tmem:{self.mem_addr}] {name}:{self.binary.hex()}")
+
+
     def show(self):
-        logger.info(f"{self.mem_addr}\t: {self.content}")
+        logger.debug(f"{self.mem_addr}\t: {self.content}")
     def show_bytes(self):
         if self.types == 'instruction':
-            b = '{:0>32b}'.format(int.from_bytes(self.binary,byteorder='little',signed=False))
-            logger.info(f"[{self.mem_addr}\t: {self.content}]\t{b}")
-        
-    def decode(self, tags):
-        if self.types == 'data':
-            return 
-        # instruction 
-        self.tags = tags 
-        r = re.match(r'([\w]+)[\s]+(.*)',self.content)
-        if not r or len(r.groups()) != 2:
-            logger.info(f"[error line:{self.line_num}\t] invaild instruction: {self.content}")
-            return 
-        self.inst_body = r.groups()[1]
-        case = r.groups()[0]
-        if case == 'addi':
-            self.I_type('000')
-        elif case == 'slti':
-            self.I_type('010')
-        elif case == 'sltiu':
-            self.I_type('011')
-        elif case == 'xori':
-            self.I_type('100')
-        elif case == 'ori':
-            self.I_type('110')
-        elif case == 'andi':
-            self.I_type('111')
-        elif case == 'slli':
-            self.S_type('001','000000')
-        elif case == 'srli':
-            self.S_type('101','000000')
-        elif case == 'srai':
-            self.S_type('101','010000')
-        elif case == 'lui':
-            self.U_type('0110111')
-        elif case == 'auipc':
-            self.U_type('0010111')
-        elif case == 'add':
-            self.R_type('000','0000000')
-        elif case == 'sub':
-            self.R_type('000','0100000')
-        elif case == 'sll':
-            self.R_type('001','0000000')
-        elif case == 'slt':
-            self.R_type('010','0000000')
-        elif case == 'sltu':
-            self.R_type('011','0000000')
-        elif case == 'xor':
-            self.R_type('100','0000000')
-        elif case == 'srl':
-            self.R_type('101','0000000')
-        elif case == 'sra':
-            self.R_type('101','0100000')
-        elif case == 'or':
-            self.R_type('110','0000000')
-        elif case == 'and':
-            self.R_type('111','0000000')
-        elif case == 'jal':
-            self.J_jal()
-        elif case == 'jalr':
-            self.J_jalr()
-        elif case == 'beq':
-            self.B_type('000')
-        elif case == 'bne':
-            self.B_type('001')
-        elif case == 'blt':
-            self.B_type('100')
-        elif case == 'bge':
-            self.B_type('101')
-        elif case == 'bltu':
-            self.B_type('110')
-        elif case == 'bgeu':
-            self.B_type('111')
-        elif case == 'lb':
-            self.Load('000')
-        elif case == 'lbu':
-            self.Load('100')
-        elif case == 'lw':
-            self.Load('010')
-        elif case == 'lwu':
-            self.Load('110')
-        elif case == 'ld':
-            self.Load('011')
-        elif case == 'sb':
-            self.Store('000')
-        elif case == 'sw':
-            self.Store('010')
-        elif case == 'sd':
-            self.Store('011')
-        else:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return 
-
-
+            logger.debug(f"[{self.mem_addr}\t: {self.content}]\t{self.word or 0:0>32b}")
 
+    def decode(self, tags, image:bytearray):
+        """ encode into image at self.mem_addr """
+        if self.types == 'data':
+            if self.binary:
+                image[self.mem_addr:self.mem_addr + len(self.binary)] = self.binary
+            return
+        # instruction
+        self.tags = tags
+        r = self.content.split(None, 1)
+        if r[0] not in formats or len(r) != 2 and formats[r[0]][0] is not Unit.System:
+            _error(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
+            return
+        case = r[0]
+        self.inst_body = r[1] if len(r) == 2 else ''
+        encode, fields = formats[case]
+        self.word = encode(self, *fields)
+        if self.word is not None:
+            _pack_word(image, self.mem_addr, self.word)
 
-    """  
+    """
     addi: imm12, rs1, 000, rd, 0010011
-    slti:  010 
-    sltiu: 011 
-    xori:  100 
+    slti:  010
+    sltiu: 011
+    xori:  100
     ori:   110
     andi:  111
     """
-    def I_type(self, funct3:str):
-        ops = re.split(r'[\s,]+',self.inst_body)
+    def I_type(self, funct3:int):
+        ops = split_ops(self.inst_body)
         if len(ops) != 3:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return 
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
         rs1 = self.decode_reg(ops[1])
-        immd, overflow = int2bin(str2int(ops[2]),12)
-        if overflow:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return 
-        self.binary = str2bytes(immd + rs1 + funct3 + rd + '0010011')     
+        immd = str2int(ops[2])
+        if not -(1 << 11) <= immd < (1 << 11):
+            return self.error_inst()
+        return (immd & 0xfff) << 20 | rs1 << 15 | funct3 << 12 | rd << 7 | 0b0010011
     """
     slli: 000000 imm6 rs1 001 rd 0010011
     srli: 000000 imm6 rs1 101 rd 0010011
     slli: 010000 imm6 rs1 101 rd 0010011
     """
-    def S_type(self, funct3:str, funct6:str):
-        ops = re.split(r'[\s,]+',self.inst_body)
+    def S_type(self, funct3:int, funct6:int):
+        ops = split_ops(self.inst_body)
         if len(ops) != 3:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return 
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
         rs1 = self.decode_reg(ops[1])
-        immd, overflow = int2bin(str2int(ops[2]),7)
-        immd = immd[1:]                
-        if overflow:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return 
-        self.binary = str2bytes(funct6 + immd + rs1 + funct3 + rd + '0010011') 
+        immd = str2int(ops[2])
+        if not -(1 << 6) <= immd < (1 << 6):
+            return self.error_inst()
+        return funct6 << 26 | (immd & 0x3f) << 20 | rs1 << 15 | funct3 << 12 | rd << 7 | 0b0010011
     """
     lui:   imm[31:12] rd 0110111
     auipc: imm[31:12] rd 0010111
     """
-    def U_type(self, opcode:str):
-        ops = re.split(r'[\s,]+',self.inst_body)
+    def U_type(self, opcode:int):
+        ops = split_ops(self.inst_body)
         if len(ops) != 2:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return         
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
         if ops[1] in self.tags:
             immd = self.tags[ops[1]]
         else:
             immd = str2int(ops[1])
-        immd, _ = int2bin(immd,32)
-        immd = immd[0:20]
-        self.binary = str2bytes(immd  + rd + opcode) 
-        
+        return (immd & 0xfffff000) | rd << 7 | opcode
+
     """
     add: 0000000 rs2 rs1 000 rd 0110011
-    sub: 0100000         000           # sub rd, rs1, rs2: rs1-rs2 
+    sub: 0100000         000           # sub rd, rs1, rs2: rs1-rs2
     sll: 0000000         001
     slt: 0000000         010
     sltu:0000000         011
@@ -314,74 +274,68 @@ class Unit:
     sra: 0100000         101
     or : 0000000         110
     and: 0000000         111
+    mul: 0000001         000
+    div: 0000001         100
+    divu:0000001         101
+    rem: 0000001         110
+    remu:0000001         111
     """
-    def R_type(self, funct3:str, funct7:str):
-        ops = re.split(r'[\s,]+',self.inst_body)
+    def R_type(self, funct3:int, funct7:int):
+        ops = split_ops(self.inst_body)
         if len(ops) != 3:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return 
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
         rs1 = self.decode_reg(ops[1])
         rs2 = self.decode_reg(ops[2])
-        self.binary = str2bytes(funct7 + rs2 + rs1 + funct3 + rd + '0110011') 
+        return funct7 << 25 | rs2 << 20 | rs1 << 15 | funct3 << 12 | rd << 7 | 0b0110011
+
+    def _offset(self, op:str, bits:int):
+        """ pc relative offset of a tag, or an immediate; None if it needs more than bits """
+        if op in self.tags:
+            immd = self.tags[op] - self.mem_addr
+        else:
+            immd = str2int(op) & (~0b11)
+        if immd > (1 << bits)-1 or immd < -(1 << bits):
+            _error(f"[error line:{self.line_num}]\timmd overflow: {self.content}")
+            return None
+        return immd & 0xffffffff
     """
     jal: imm[21:2] rd 1101111
     jalr:imm[13:2] rs1 000 rd 1100111
     """
     def J_jal(self):
-        ops = re.split(r'[\s,]+',self.inst_body)
+        ops = split_ops(self.inst_body)
         if len(ops) != 2:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return         
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
-        if ops[1] in self.tags:
-            immd = self.tags[ops[1]] - self.mem_addr
-        else:
-            immd = str2int(ops[1]) & (~0b11)
-        if immd > (1 << 21)-1 or immd < -(1<<21):
-            logger.info(f"[error line:{self.line_num}]\timmd overflow: {self.content}")
-            return       
-        immd, _ = int2bin(immd,32)
-        immd = immd[-21-1:-2]
-        self.binary = str2bytes(immd  + rd + '1101111') 
+        immd = self._offset(ops[1], 21)
+        if immd is None:
+            return None
+        return (immd >> 2 & 0xfffff) << 12 | rd << 7 | 0b1101111
     def J_jalr(self):
-        ops = re.split(r'[\s,]+',self.inst_body)
+        ops = split_ops(self.inst_body)
         if len(ops) != 3:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return         
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
         rs1 = self.decode_reg(ops[1])
-        if ops[2] in self.tags:
-            immd = self.tags[ops[2]] - self.mem_addr
-        else:
-            immd = str2int(ops[2]) & (~0b11)
-        if immd > (1 << 13)-1 or immd < -(1<<13):
-            logger.info(f"[error line:{self.line_num}]\timmd overflow: {self.content}")
-            return       
-        immd, _ = int2bin(immd,32)
-        immd = immd[-13-1:-2]
-        self.binary = str2bytes(immd  + rs1 + '000' + rd + '1100111') 
+        immd = self._offset(ops[2], 13)
+        if immd is None:
+            return None
+        return (immd >> 2 & 0xfff) << 20 | rs1 << 15 | rd << 7 | 0b1100111
     """
     beq: imm[13:7] rs2 rs1 000 imm[6:2] 1100011
     """
-    def B_type(self, funct3:str):
-        ops = re.split(r'[\s,]+',self.inst_body)
+    def B_type(self, funct3:int):
+        ops = split_ops(self.inst_body)
         if len(ops) != 3:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return         
+            return self.error_inst()
         rs1 = self.decode_reg(ops[0])
         rs2 = self.decode_reg(ops[1])
-        if ops[2] in self.tags:
-            immd = self.tags[ops[2]] - self.mem_addr
-        else:
-            immd = str2int(ops[2]) & (~0b11)
-        if immd > (1 << 13)-1 or immd < -(1<<13):
-            logger.info(f"[error line:{self.line_num}]\timmd overflow: {self.content}")
-            return       
-        immd, _ = int2bin(immd,32)
-        immd1 = immd[-13-1:-7]
-        immd2 = immd[-6-1:-2]
-        self.binary = str2bytes(immd1  + rs2 + rs1 + funct3 + immd2 + '1100011')   
+        immd = self._offset(ops[2], 13)
+        if immd is None:
+            return None
+        return ((immd >> 7 & 0x7f) << 25 | rs2 << 20 | rs1 << 15 | funct3 << 12
+                | (immd >> 2 & 0x1f) << 7 | 0b1100011)
     """
     lb: imm[11:0] rs1 000 rd 0000011   # mem[rs1 + immd] -> rd
     lbu:100
@@ -389,70 +343,292 @@ class Unit:
     lwu:110
     ld: 011
     """
-    def Load(self, funct3:str):
-        ops = re.split(r'[\s,()]+',self.inst_body)
+    def Load(self, funct3:int):
+        ops = split_ops(self.inst_body, ',()')
         if len(ops) != 4:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return   
+            return self.error_inst()
         rd = self.decode_reg(ops[0])
-        rs1 = self.decode_reg(ops[2]) 
+        rs1 = self.decode_reg(ops[2])
         if ops[1] in self.tags:
-            immd = self.tags[ops[1]]  
+            immd = self.tags[ops[1]]
         else:
-            immd = str2int(ops[1])   
-        immd, _ = int2bin(immd,12)  
-        self.binary = str2bytes(immd  + rs1 + funct3 + rd + '0000011')
+            immd = str2int(ops[1])
+        return (immd & 0xfff) << 20 | rs1 << 15 | funct3 << 12 | rd << 7 | 0b0000011
     """
     sb: imm[11:5] rs2 rs1 000 imm[4:0] 0100011
     sw: 010
     sd: 011
     """
-    def Store(self, funct3:str):
-        ops = re.split(r'[\s,()]+',self.inst_body)
+    def Store(self, funct3:int):
+        ops = split_ops(self.inst_body, ',()')
         if len(ops) != 4:
-            logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-            return   
+            return self.error_inst()
         rs2 = self.decode_reg(ops[0])
-        rs1 = self.decode_reg(ops[2]) 
+        rs1 = self.decode_reg(ops[2])
         if ops[1] in self.tags:
-            immd = self.tags[ops[1]]  
+            immd = self.tags[ops[1]]
         else:
-            immd = str2int(ops[1])   
-        immd, _ = int2bin(immd,12)  
-        immd1 = immd[-11-1:-5]
-        immd2 = immd[-4-1:]
-        self.binary = str2bytes(immd1  + rs2 + rs1 + funct3 + immd2 + '0100011')
-    
+            immd = str2int(ops[1])
+        return ((immd >> 5 & 0x7f) << 25 | rs2 << 20 | rs1 << 15 | funct3 << 12
+                | (immd & 0x1f) << 7 | 0b0100011)
+
+    """
+    ecall:  000000000000 00000 000 00000 1110011
+    ebreak: 000000000001 00000 000 00000 1110011
+    """
+    def System(self, funct12:int):
+        if self.inst_body:
+            return self.error_inst()
+        return funct12 << 20 | 0b1110011
+
+    def symbols(self)->list:
+        """ operands of an instruction that are tags """
+        r = self.content.split(None, 1)
+        if len(r) != 2:
+            return []
+        return [op for op in split_ops(r[1], ',()') if op and op not in _regs and not _value.match(op)]
+
     def error_inst(self):
-        logger.info(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
-        return 
+        _error(f"[error line:{self.line_num}]\tinvaild instruction: {self.content}")
+        return None
     def decode_reg(self, a:str):
+        if a in _regs:
+            return _regs[a]
         try:
-            return int2bin(int(a[1:]),6)[0][1:]
-        except:
-            logger.info('[error] wrong register name: '+a)
-            return '00000'
-        
-
-        
-
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-# file
-fh = logging.FileHandler(os.path.join(os.path.abspath(os.path.dirname(__file__)), "asm.log"), mode='w')
-fh.setLevel(logging.INFO)
-# formatter = logging.Formatter("%(asctime)s (line:%(lineno)d) %(message)s ",'%Y/%m/%d %I:%M:%S')
-formatter = logging.Formatter("[line:%(lineno)d] %(message)s ")
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-# console
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-logger.info(">>>> start")
-
-
-with open("test.asm", 'r', encoding='utf-8') as f:
-    test = ASM(f.read())
+            return int(a[1:]) & 0x1f
+        except ValueError:
+            _error('[error] wrong register name: '+a)
+            return 0
+
+
+# mnemonic -> (encoder, fields)
+formats = {
+    'addi':  (Unit.I_type, (0b000,)),
+    'slti':  (Unit.I_type, (0b010,)),
+    'sltiu': (Unit.I_type, (0b011,)),
+    'xori':  (Unit.I_type, (0b100,)),
+    'ori':   (Unit.I_type, (0b110,)),
+    'andi':  (Unit.I_type, (0b111,)),
+    'slli':  (Unit.S_type, (0b001, 0b000000)),
+    'srli':  (Unit.S_type, (0b101, 0b000000)),
+    'srai':  (Unit.S_type, (0b101, 0b010000)),
+    'lui':   (Unit.U_type, (0b0110111,)),
+    'auipc': (Unit.U_type, (0b0010111,)),
+    'add':   (Unit.R_type, (0b000, 0b0000000)),
+    'sub':   (Unit.R_type, (0b000, 0b0100000)),
+    'sll':   (Unit.R_type, (0b001, 0b0000000)),
+    'slt':   (Unit.R_type, (0b010, 0b0000000)),
+    'sltu':  (Unit.R_type, (0b011, 0b0000000)),
+    'xor':   (Unit.R_type, (0b100, 0b0000000)),
+    'srl':   (Unit.R_type, (0b101, 0b0000000)),
+    'sra':   (Unit.R_type, (0b101, 0b0100000)),
+    'or':    (Unit.R_type, (0b110, 0b0000000)),
+    'and':   (Unit.R_type, (0b111, 0b0000000)),
+    'mul':   (Unit.R_type, (0b000, 0b0000001)),
+    'div':   (Unit.R_type, (0b100, 0b0000001)),
+    'divu':  (Unit.R_type, (0b101, 0b0000001)),
+    'rem':   (Unit.R_type, (0b110, 0b0000001)),
+    'remu':  (Unit.R_type, (0b111, 0b0000001)),
+    'jal':   (Unit.J_jal, ()),
+    'jalr':  (Unit.J_jalr, ()),
+    'beq':   (Unit.B_type, (0b000,)),
+    'bne':   (Unit.B_type, (0b001,)),
+    'blt':   (Unit.B_type, (0b100,)),
+    'bge':   (Unit.B_type, (0b101,)),
+    'bltu':  (Unit.B_type, (0b110,)),
+    'bgeu':  (Unit.B_type, (0b111,)),
+    'lb':    (Unit.Load, (0b000,)),
+    'lbu':   (Unit.Load, (0b100,)),
+    'lw':    (Unit.Load, (0b010,)),
+    'lwu':   (Unit.Load, (0b110,)),
+    'ld':    (Unit.Load, (0b011,)),
+    'sb':    (Unit.Store, (0b000,)),
+    'sw':    (Unit.Store, (0b010,)),
+    'sd':    (Unit.Store, (0b011,)),
+    'ecall': (Unit.System, (0,)),
+    'ebreak':(Unit.System, (1,)),
+}
+
+
+def assemble(src:str, out:str):
+    """
+    assemble the file src into the raw memory image out, in two passes over the file
+        pass 1: addresses of the tags and size of the image
+        pass 2: encode every unit straight into out, mapped into memory
+    only the tags are kept between the passes -> (tags, size), None on error, out is removed then
+    """
+    start = errors
+    tags = {}
+    size = mem_addr = 0
+    with open(src, 'r', encoding='utf-8') as f:
+        for line, N in source_lines(f):
+            if _is_tag(line):
+                if line[:-1] in tags:
+                    _error(f"[error line:{N}] tag used twice: {line[:-1]}")
+                    return None
+                tags[line[:-1]] = mem_addr
+            else:
+                mem_addr = Unit(line, N, mem_addr).next_mem_addr
+                size = max(size, mem_addr)
+    logger.debug('found tags: {}'.format(tags))
+    if errors != start:
+        return None
+
+    with open(out, 'w+b') as f:
+        if size == 0:
+            return tags, size
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as image, open(src, 'r', encoding='utf-8') as source:
+            mem_addr = 0
+            for line, N in source_lines(source):
+                if not _is_tag(line):
+                    unit = Unit(line, N, mem_addr)
+                    unit.decode(tags, image)
+                    mem_addr = unit.next_mem_addr
+    if errors != start:                 # an instruction or value that did not encode
+        os.remove(out)
+        return None
+    return tags, size
+
+
+# the tag of these is an address, not an offset from pc: it moves with the object
+_absolute = {Unit.U_type, Unit.Load, Unit.Store}
+
+def assemble_object(src:str):
+    """
+    assemble the file src into a relocatable object at address 0, for link.py
+    .globl tag, ... exports tags, the others are local to the file, .addr is relative to the object
+    an instruction using a tag of another file, or a tag as an address, is kept as a relocation:
+    its bytes are 0 until the linker encodes it again at its address
+    -> (image, tags, exports, relocs), relocs: [(mem_addr, line_number, content)]; None on error
+    """
+    start = errors
+    tags = {}
+    exports = []
+    units = []
+    mem_addr = 0
+    with open(src, 'r', encoding='utf-8') as f:
+        for line, N in source_lines(f):
+            if _is_tag(line):
+                if line[:-1] in tags:
+                    _error(f"[error line:{N}] tag used twice: {line[:-1]}")
+                    return None
+                tags[line[:-1]] = mem_addr
+                continue
+            unit = Unit(line, N, mem_addr)
+            r = line.split(None, 1)
+            if r[0] == '.globl' and len(r) == 2:
+                exports += [(name, N) for name in split_ops(r[1])]
+            units.append(unit)
+            mem_addr = unit.next_mem_addr
+    for name, N in exports:
+        if name not in tags:
+            _error(f"[error line:{N}] .globl of an undefined tag: {name}")
+            return None
+
+    image = bytearray(max([0] + [u.next_mem_addr for u in units]))
+    relocs = []
+    for unit in units:
+        symbols = unit.symbols() if unit.types == 'instruction' else []
+        absolute = symbols and formats.get(unit.content.split()[0], (None,))[0] in _absolute
+        if absolute or any(s not in tags for s in symbols):
+            relocs.append((unit.mem_addr, unit.line_num, unit.content))
+        else:
+            unit.decode(tags, image)
+    if errors != start:
+        return None
+    return image, tags, [name for name, N in exports], relocs
+
+# object file (.o), little-endian:
+#     header      "<4sHHIIII"         magic, version, 0, image size, n_tag, n_reloc, string_size
+#     tags        n_tag x "<IIII"     (name offset, name size, address, exported)
+#     relocs      n_reloc x "<IIII"   (address, line, content offset, content size)
+#     image
+#     strings     utf8, the names and contents
+OBJ_MAGIC = b"RVO\0"
+OBJ_VERSION = 1
+_obj_header = struct.Struct("<4sHHIIII")
+
+def write_object(filepath:str, image:bytes, tags:dict, exports:list, relocs:list):
+    strings = bytearray()
+    def string(s):
+        offset = len(strings)
+        strings.extend(s.encode('utf8'))
+        return offset, len(strings) - offset
+    tag_table = []
+    for name, addr in tags.items():
+        tag_table += [*string(name), addr, name in exports]
+    reloc_table = []
+    for addr, N, content in relocs:
+        reloc_table += [addr, N, *string(content)]
+    with open(filepath, 'wb') as f:
+        f.write(_obj_header.pack(OBJ_MAGIC, OBJ_VERSION, 0, len(image), len(tags), len(relocs), len(strings)))
+        f.write(struct.pack(f"<{len(tag_table)}I", *tag_table))
+        f.write(struct.pack(f"<{len(reloc_table)}I", *reloc_table))
+        f.write(image)
+        f.write(strings)
+
+def load_object(filepath:str):
+    """ -> (image, tags, exports, relocs) as given to write_object() """
+    with open(filepath, 'rb') as f:
+        buf = f.read()
+    magic, version, _, size, n_tag, n_reloc, string_size = _obj_header.unpack_from(buf, 0)
+    if magic != OBJ_MAGIC or version != OBJ_VERSION:
+        raise ValueError(f"{filepath}: not a version {OBJ_VERSION} object file")
+    offset = _obj_header.size
+    tag_table = struct.unpack_from(f"<{n_tag * 4}I", buf, offset)
+    offset += n_tag * 16
+    reloc_table = struct.unpack_from(f"<{n_reloc * 4}I", buf, offset)
+    offset += n_reloc * 16
+    image = bytearray(buf[offset:offset + size])
+    strings = buf[offset + size:offset + size + string_size]
+    def string(start, n):
+        return str(strings[start:start + n], 'utf8')
+    tags = {}
+    exports = []
+    for i in range(0, n_tag * 4, 4):
+        name = string(tag_table[i], tag_table[i + 1])
+        tags[name] = tag_table[i + 2]
+        if tag_table[i + 3]:
+            exports.append(name)
+    relocs = [(reloc_table[i], reloc_table[i + 1], string(reloc_table[i + 2], reloc_table[i + 3]))
+              for i in range(0, n_reloc * 4, 4)]
+    return image, tags, exports, relocs
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="assemble a source file into a raw memory image")
+    cli.add_argument("file", help="source")
+    cli.add_argument("-o", help="output image, default: file with .bin, or .o with -c")
+    cli.add_argument("-c", action="store_true", help="write a relocatable object for link.py")
+    cli.add_argument("-v", action="store_true", help="log every unit")
+    args = cli.parse_args()
+
+    logger.setLevel(logging.DEBUG if args.v else logging.INFO)
+    # file
+    fh = logging.FileHandler(os.path.join(os.path.abspath(os.path.dirname(__file__)), "asm.log"), mode='w')
+    # formatter = logging.Formatter("%(asctime)s (line:%(lineno)d) %(message)s ",'%Y/%m/%d %I:%M:%S')
+    formatter = logging.Formatter("[line:%(lineno)d] %(message)s ")
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+    # console
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.info(">>>> start")
+
+    out = args.o or os.path.splitext(args.file)[0] + (".o" if args.c else ".bin")
+    if args.c:
+        obj = assemble_object(args.file)
+        if obj is None:
+            sys.exit(1)
+        write_object(out, *obj)
+        logger.info(f"{len(obj[2])} exported tags, {len(obj[3])} relocations, {len(obj[0])} bytes -> {out}")
+        sys.exit(0)
+    if args.v:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            ASM(f.read())                       # the listing
+    result = assemble(args.file, out)
+    if result is None:
+        sys.exit(1)
+    logger.info(f"{len(result[0])} tags, {result[1]} bytes -> {out}")
@@ -0,0 +1,295 @@
+"""
+benchmarks on generated tinyc programs
+
+    python bench.py parse [-n 10000 100000 1000000] [--earley-max 10000]
+    python bench.py compile [-n 100000]
+    python bench.py run [-n 100000] [--fib 20]
+    python bench.py check
+"""
+import io
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+import tempfile
+import contextlib
+import tinyc
+import pcode
+import regvm
+import jit
+import asm
+import riscv
+import test
+import logs
+
+
+_func = """
+int f{i}(int a, int b) {{
+    int c;
+    c = a * 3 + b;
+    while (c > 0) {{
+        c = c - 1;
+        if (c == 5 | c == 7) {{
+            continue;
+        }}
+        print(c);
+    }}
+    return c;
+}}
+"""
+
+_main = """
+int main() {
+    int x;
+    x = f0(1, 2);
+    print(x);
+    return 0;
+}
+"""
+
+_cpu = """
+int main() {{
+    int i;
+    int s;
+    i = 0;
+    s = 0;
+    while (i < {n}) {{
+        s = s + i * 2 % 7;
+        i = i + 1;
+    }}
+    print(s);
+    s = fib({fib});
+    print(s);
+    return 0;
+}}
+
+int fib(int n) {{
+    if (n < 2) {{
+        return n;
+    }}
+    return fib(n - 1) + fib(n - 2);
+}}
+"""
+
+# regression programs: every build must print what the plain build prints
+_checks = {
+    "dead_var": """
+int main() {
+    int x;
+    x = 1;
+    if (x) {
+        x = 2;
+        print(x);
+        return 0;
+        int y;
+    }
+    y = 3;
+    print(y);
+    return 0;
+}
+""",
+    "wrap_branch": """
+int main() {
+    while (18446744073709551616) {
+        print("taken");
+        break;
+    }
+    print("done");
+    return 0;
+}
+""",
+    "wrap_fold": """
+int main() {
+    int y;
+    y = 18446744073709551615 == 0 - 1;
+    print(y);
+    if (18446744073709551616) {
+        print("taken");
+    }
+    return 0;
+}
+""",
+    "block_var": """
+int main() {
+    int i;
+    i = 0;
+    while (i < 3) {
+        int t;
+        t = i * 2;
+        print(t);
+        i = i + 1;
+    }
+    if (i) {
+        int u;
+        u = i + 10;
+        print(u);
+    }
+    return 0;
+}
+""",
+}
+
+_builds = [
+    ("plain",           dict(), False),
+    ("-O",              dict(), True),
+    ("single-pass",     dict(single_pass=True), False),
+    ("single-pass -O",  dict(single_pass=True), True),
+]
+
+def _run_riscv(program):
+    """ riscv.py, assembled by asm.py and run on test.py """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "check")
+        riscv.RiscvProgram(program).write(path + ".s")
+        if asm.assemble(path + ".s", path + ".bin") is None:
+            raise RuntimeError("asm.py failed on the riscv.py output")
+        cpu = test.Cpu()
+        cpu.load_program(path + ".bin")
+        cpu.run()
+        if cpu.exit_code == -1:
+            raise RuntimeError("test.py faulted")
+
+# the engines a check runs on, every one has to print what pcode.py prints
+_engines = [
+    ("pcode",       lambda p: p.run()),
+    ("regvm",       lambda p: regvm.RegisterProgram(p).run()),
+    ("jit",         lambda p: jit.JitProgram(p, threshold=0).run()),
+    ("jit --interpret", lambda p: jit.JitProgram(p, interpret=True).run()),
+    ("riscv",       _run_riscv),
+]
+
+def gen_source(n_lines: int) -> str:
+    """ a tinyc program of about n_lines lines """
+    n_func = max(1, n_lines // _func.count('\n'))
+    return _main + ''.join(_func.format(i=i) for i in range(n_func))
+
+def gen_pcode(source: str) -> str:
+    """ compile source, return the pcode text """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench")
+        with open(path + ".c", 'w', encoding='utf8') as f:
+            f.write(source)
+        tinyc.GenPcode(path + ".c").gen(path + ".asm")
+        with open(path + ".asm", 'r', encoding='utf8') as f:
+            return f.read().strip()
+
+def _timeit(f, *args):
+    t = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - t
+
+
+def bench_parse(lines: list, earley_max: int):
+    print("{:>10}{:>10}{:>12}{:>16}".format("lines", "grammar", "parser", "lines/s"))
+    for n in lines:
+        source = gen_source(n)
+        texts = {"tinyc": source, "pcode": gen_pcode(source)}
+        for name, text in texts.items():
+            n_lines = text.count('\n') + 1
+            module = tinyc if name == "tinyc" else pcode
+            for earley in [False, True]:
+                if earley and n > earley_max:
+                    continue
+                parser = module.get_parser(earley)
+                t = _timeit(parser.parse, text)
+                print("{:>10}{:>10}{:>12}{:>16.0f}".format(n_lines, name, "earley" if earley else "lalr", n_lines / t))
+
+def bench_compile(lines: list):
+    """ .c -> .asm, echo to stdout (the old default) vs quiet streaming output """
+    modes = [
+        ("echo",        dict(verbose=2)),
+        ("quiet",       dict()),
+        ("single-pass", dict(single_pass=True)),
+    ]
+    print("{:>10}{:>14}{:>10}{:>16}".format("lines", "mode", "seconds", "lines/s"))
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        for n in lines:
+            path = os.path.join(tmp, "bench")
+            with open(path + ".c", 'w', encoding='utf8') as f:
+                f.write(gen_source(n))
+            for name, kwargs in modes:
+                with contextlib.redirect_stdout(devnull):
+                    t = _timeit(lambda: tinyc.GenPcode(path + ".c", **kwargs).gen(path + ".asm"))
+                print("{:>10}{:>14}{:>10.2f}{:>16.0f}".format(n, name, t, n / t))
+
+def bench_run(n: int, fib: int):
+    """ a loop of n iterations and fib(fib), on every backend """
+    modes = [
+        ("dispatch",    lambda p: p.run()),
+        ("threaded",    lambda p: p.run(threaded=True)),
+        ("regvm",       lambda p: regvm.RegisterProgram(p).run()),
+        ("jit",         lambda p: jit.JitProgram(p).run()),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench")
+        with open(path + ".c", 'w', encoding='utf8') as f:
+            f.write(_cpu.format(n=n, fib=fib))
+        tinyc.GenPcode(path + ".c").gen(path + ".asm")
+        program = pcode.Program(path + ".asm")
+    print("{:>14}{:>10}{:>10}".format("mode", "seconds", "speedup"))
+    base = None
+    for name, f in modes:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            t = _timeit(f, program)
+        base = base or t
+        print("{:>14}{:>10.2f}{:>10.1f}".format(name, t, base / t))
+
+def check() -> bool:
+    """ run the regression programs of every build on every engine, compare the output with plain pcode.py """
+    failed = 0
+    logs.error_logger.addHandler(logging.NullHandler())    # no instructions/s line of test.py per run
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, source in _checks.items():
+            path = os.path.join(tmp, name + ".c")
+            with open(path, 'w', encoding='utf8') as f:
+                f.write(source)
+            expected = None
+            ok = True
+            for build, kwargs, optimize in _builds:
+                for engine, run in _engines:
+                    buf = io.StringIO()
+                    try:
+                        with contextlib.redirect_stdout(buf):
+                            gen = tinyc.GenPcode(path, **kwargs)
+                            gen.gen(optimize=optimize)
+                            run(pcode.Program(pcodes=gen.pcodes))
+                    except Exception:
+                        ok = False
+                        print(f"{name}: {build} on {engine} raises")
+                        traceback.print_exc(limit=-1)
+                        continue
+                    out = [line for line in buf.getvalue().splitlines()
+                           if not line.startswith("[peephole]") and line not in ["start!", "finish!"]]
+                    if expected is None:
+                        expected = out
+                    elif out != expected:
+                        ok = False
+                        print(f"{name}: {build} on {engine} prints {out}, plain on pcode prints {expected}")
+            print(f"{name:>14}  {'ok' if ok else 'FAILED'}")
+            failed += not ok
+    return failed == 0
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = cli.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("parse", help="parse throughput, lalr vs earley")
+    p.add_argument("-n", type=int, nargs="+", default=[10000, 100000, 1000000], help="source lines")
+    p.add_argument("--earley-max", type=int, default=10000, help="largest input given to earley")
+    p = sub.add_parser("compile", help="compile time, echo vs quiet output")
+    p.add_argument("-n", type=int, nargs="+", default=[100000], help="source lines")
+    p = sub.add_parser("run", help="run time of the dispatch loop, threaded code, register VM and JIT")
+    p.add_argument("-n", type=int, default=100000, help="loop iterations")
+    p.add_argument("--fib", type=int, default=20, help="argument of the recursive fib")
+    sub.add_parser("check", help="regression programs, every build on every engine prints the same")
+    args = cli.parse_args()
+
+    if args.cmd == "parse":
+        bench_parse(args.n, args.earley_max)
+    elif args.cmd == "compile":
+        bench_compile(args.n)
+    elif args.cmd == "run":
+        bench_run(args.n, args.fib)
+    elif args.cmd == "check":
+        sys.exit(0 if check() else 1)
@@ -0,0 +1,139 @@
+"""
+content addressed cache of compiled artifacts
+
+an artifact (.asm or .tcb) is stored under the hash of everything it was built
+from: the source text, the grammar, the compiler version and the options, so an
+unchanged file is copied out of the cache instead of parsed again
+
+    cache_dir/<key><ext>        the artifact
+    cache_dir/<key>.json        manifest: source path, artifact size and the hash
+                                of every function's pcode
+
+the hash of a function covers its pcode without the // line: comments, so a
+function whose code did not change keeps its hash when lines above it move;
+a linker can reuse it by that hash
+
+the cache is bounded to max_bytes, a hit refreshes the entry's mtime and the
+least recently used entries are removed first
+"""
+import os
+import json
+import shutil
+import hashlib
+import parser_cache
+
+
+cache_dir = os.path.join(parser_cache.cache_dir, "build") if parser_cache.cache_dir else ""
+MAX_BYTES = 64 << 20
+
+
+def digest(*parts) -> str:
+    """ hash of str/bytes parts, a part cannot run into the next one """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+def function_hashes(pcodes: list) -> dict:
+    """ pcode lines (str) -> {function name: hash of its pcode} """
+    hashes = {}
+    name = None
+    body = []
+    for s in pcodes + ["def :"]:
+        s = s.split("//", 1)[0].strip()
+        if not s:
+            continue
+        if s.startswith("def ") and s.endswith(":"):
+            if name is not None:
+                hashes[name] = digest("\n".join(body))[:16]
+            name = s[4:-1].strip()
+            body = []
+        else:
+            body.append(s)
+    return hashes
+
+
+class BuildCache:
+    def __init__(self, directory: str = cache_dir, max_bytes: int = MAX_BYTES):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.dir, key + ext)
+
+    def get(self, key: str, ext: str, out: str) -> bool:
+        """ copy the artifact of key to out, False if it is not cached """
+        if not self.dir:
+            return False
+        path = self._path(key, ext)
+        try:
+            os.utime(self._path(key, ".json"))      # most recently used, and complete
+            os.utime(path)
+            shutil.copyfile(path, out)
+        except FileNotFoundError:                   # never built, or evicted meanwhile
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key: str, ext: str, artifact: str, manifest: dict):
+        """ store a copy of the file artifact and its manifest; evict() once the build is done """
+        if not self.dir:
+            return
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            tmp = f"{self._path(key, ext)}.{os.getpid()}.tmp"
+            shutil.copyfile(artifact, tmp)
+            os.replace(tmp, self._path(key, ext))
+            tmp = f"{self._path(key, '.json')}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(tmp, self._path(key, ".json"))   # the manifest last: an entry is complete once it exists
+        except OSError as e:
+            print(f"[warning] cannot write build cache {self.dir}: {e}")
+
+    def manifest(self, key: str) -> dict:
+        """ the manifest of a cached artifact, None if it is not cached """
+        try:
+            with open(self._path(key, ".json"), 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def evict(self):
+        """ remove the least recently used entries until the cache fits in max_bytes """
+        entries = {}                                # key -> [mtime, size, paths]
+        try:
+            files = list(os.scandir(self.dir))
+        except FileNotFoundError:
+            return
+        for entry in files:
+            if entry.name.endswith(".tmp"):
+                continue
+            key = entry.name.split(".", 1)[0]
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            e = entries.setdefault(key, [0, 0, []])
+            e[0] = max(e[0], st.st_mtime)
+            e[1] += st.st_size
+            e[2].append(entry.path)
+        total = sum(e[1] for e in entries.values())
+        for mtime, size, paths in sorted(entries.values()):
+            if total <= self.max_bytes:
+                break
+            for path in sorted(paths, key=lambda p: p.endswith(".json"), reverse=True):
+                try:
+                    os.remove(path)                 # the manifest first, the entry is gone at once
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
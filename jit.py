@@ -0,0 +1,271 @@
+"""
+tier-up JIT: hot functions of the register VM are compiled to python functions
+
+functions start interpreted; every call and every backward jmp adds to the
+function's counter, when it reaches threshold the whole function is translated
+to python source, compile()d once and called directly from then on
+
+    registers       -> locals r0, r1, ... (args are the leading parameters)
+    basic blocks    -> `if _b == <index>:` inside `while True:`, a jump sets _b
+    operators       -> inline python expressions, comparisons branch natively
+    calls           -> F<index>(args), rebound when the callee gets compiled
+
+a loop that gets hot in a function which is only called once (main) enters the
+compiled function in the middle: F(*registers, _b=<loop head>)
+
+    python jit.py c/tinyc.asm [--threshold 100] [--interpret] [--dump]
+"""
+import sys
+import threading
+from ops import SIGN64, MASK64, wrap64, binary_ops, unary_ops
+from regvm import (MOV, MOVI, BIN, BINI, BINK, UN, JMP, JZ, JNZ, BJZ, BJZI,
+                   INC, DEC, CALL, RET, RETI, PRINT, PRINTS, INVALID, RegisterProgram)
+import pcode
+
+
+_compare = {'cmp_eq': "==", 'cmp_ne': "!=", 'cmp_gt': ">", 'cmp_lt': "<", 'cmp_ge': ">=", 'cmp_le': "<="}
+_wrapped = {'op_add': "+", 'op_sub': "-", 'op_mul': "*"}
+_bitwise = {'op_and': "&", 'op_or': "|"}
+
+_op_names = {f: name for name, f in list(binary_ops.items()) + list(unary_ops.items())}
+
+_CALL_STACK = 4096              # bytes of C stack a nested call may take, run() sizes its thread by it
+
+
+class Halt(Exception):
+    """ invalid opcode, stops the program """
+
+
+def _binary(f, a: str, b: str) -> str:
+    name = _op_names[f]
+    if name in _compare:
+        return f"(1 if {a} {_compare[name]} {b} else 0)"
+    if name in _wrapped:
+        return f"(({a} {_wrapped[name]} {b} + SIGN64) & MASK64) - SIGN64"
+    if name in _bitwise:
+        return f"{a} {_bitwise[name]} {b}"
+    return f"{name}({a}, {b})"
+
+def _unary(f, a: str) -> str:
+    name = _op_names[f]
+    if name == 'op_not':
+        return f"~{a}"
+    if name == 'op_neg':
+        return f"((-{a} + SIGN64) & MASK64) - SIGN64"
+    return f"{name}({a})"
+
+def _is_zero(f, a: str, b: str) -> str:
+    """ condition of BJZ: f(a, b) == 0 """
+    name = _op_names[f]
+    if name in _compare:
+        return f"not {a} {_compare[name]} {b}"
+    return f"{_binary(f, a, b)} == 0"
+
+
+class JitProgram(RegisterProgram):
+    def __init__(self, program: pcode.Program, threshold: int = 100, interpret: bool = False):
+        super().__init__(program)
+        self.threshold = threshold
+        self.interpret = interpret              # never compile
+        self.counts = [0] * len(self.funcs)
+        self.compiled = [None] * len(self.funcs)
+        self.sources = {}                       # name -> python source of the compiled functions
+        self.ns = {"SIGN64": SIGN64, "MASK64": MASK64, "wrap64": wrap64, "Halt": Halt}
+        self.ns.update(binary_ops)
+        self.ns.update(unary_ops)
+        for i in range(len(self.funcs)):
+            self.ns[f"F{i}"] = self._entry(i)
+
+    def _entry(self, i: int):
+        """ the callee of interpreted functions and of F<i> in compiled ones """
+        return lambda *args: self.call(i, args)
+
+    def _hot(self, i: int) -> bool:
+        self.counts[i] += 1
+        if self.counts[i] >= self.threshold and not self.interpret:
+            self.compile(i)
+            return True
+        return False
+
+    def call(self, i: int, args: tuple):
+        if self.compiled[i] is None and not self._hot(i):
+            return self._interpret(i, args)
+        return self.compiled[i](*args)
+
+    def source(self, i: int) -> str:
+        func = self.funcs[i]
+        code = func.code
+        r = [f"r{k}" for k in range(func.n_regs)]
+        def val(is_reg, v):
+            return r[v] if is_reg else repr(v)
+
+        leaders = {0}
+        for k, inst in enumerate(code):
+            if inst[0] in [JMP, JZ, JNZ, BJZ, BJZI, RET, RETI]:
+                leaders.add(k + 1)
+            if inst[0] in [JMP, JZ, JNZ]:
+                leaders.add(inst[-1])
+            elif inst[0] in [BJZ, BJZI]:
+                leaders.add(inst[4])
+        leaders = sorted(k for k in leaders if k < len(code))
+
+        lines = [f"def F{i}({', '.join(f'{x}=0' for x in r)}, _b=0):  # {func.name}",
+                  "    while True:"]
+        for start, end in zip(leaders, leaders[1:] + [len(code)]):
+            lines.append(f"        if _b == {start}:")
+            body = []
+            for inst in code[start:end]:
+                op = inst[0]
+                if op == MOV:
+                    body.append(f"{r[inst[1]]} = {r[inst[2]]}")
+                elif op == MOVI:
+                    body.append(f"{r[inst[1]]} = {inst[2]!r}")
+                elif op in [BIN, BINI, BINK]:
+                    a = val(op != BINK, inst[3])
+                    b = val(op != BINI, inst[4])
+                    body.append(f"{r[inst[2]]} = {_binary(inst[1], a, b)}")
+                elif op == UN:
+                    body.append(f"{r[inst[2]]} = {_unary(inst[1], r[inst[3]])}")
+                elif op == JMP:
+                    body += [f"_b = {inst[1]}", "continue"]
+                elif op in [JZ, JNZ]:
+                    body += [f"if {r[inst[1]]} {'==' if op == JZ else '!='} 0:",
+                             f"    _b = {inst[2]}", "    continue"]
+                elif op in [BJZ, BJZI]:
+                    cond = _is_zero(inst[1], r[inst[2]], val(op == BJZ, inst[3]))
+                    body += [f"if {cond}:", f"    _b = {inst[4]}", "    continue"]
+                elif op in [INC, DEC]:
+                    x = r[inst[1]]
+                    body.append(f"{x} = (({x} {'+' if op == INC else '-'} 1 + SIGN64) & MASK64) - SIGN64")
+                elif op == CALL:
+                    args = ", ".join(val(not imm, v) for imm, v in inst[3])
+                    body.append(f"{r[inst[2]]} = F{inst[1]}({args})")
+                elif op in [RET, RETI]:
+                    body.append(f"return {val(op == RET, inst[1])}")
+                elif op == PRINT:
+                    body.append(f"print(f'>>> {{{r[inst[1]]}}}')")
+                elif op == PRINTS:
+                    body.append(f"print({'>>> ' + inst[1]!r})")
+                else:
+                    body += [f"print({'invalid opcode: ' + inst[1]!r})", "raise Halt"]
+            if code[end - 1][0] not in [JMP, RET, RETI, INVALID]:
+                body.append(f"_b = {end}")                  # falls into the next block
+            lines += ["            " + x for x in body]
+        return "\n".join(lines) + "\n"
+
+    def compile(self, i: int):
+        src = self.source(i)
+        exec(compile(src, f"<jit {self.funcs[i].name}>", "exec"), self.ns)
+        self.compiled[i] = self.ns[f"F{i}"]
+        self.sources[self.funcs[i].name] = src
+
+    def _interpret(self, i: int, args: tuple):
+        """ one call of function i on the register code """
+        func = self.funcs[i]
+        code = func.code
+        r = list(args) + [0] * (func.n_regs - len(args))
+        pc = 0
+        while True:
+            inst = code[pc]
+            pc += 1
+            op = inst[0]
+            if op == BIN:
+                r[inst[2]] = inst[1](r[inst[3]], r[inst[4]])
+            elif op == BINI:
+                r[inst[2]] = inst[1](r[inst[3]], inst[4])
+            elif op == BJZI:
+                if inst[1](r[inst[2]], inst[3]) == 0:
+                    pc = inst[4]
+            elif op == BJZ:
+                if inst[1](r[inst[2]], r[inst[3]]) == 0:
+                    pc = inst[4]
+            elif op == MOV:
+                r[inst[1]] = r[inst[2]]
+            elif op == MOVI:
+                r[inst[1]] = inst[2]
+            elif op == JMP:
+                if inst[1] < pc and (self.compiled[i] is not None or self._hot(i)):
+                    return self.compiled[i](*r, _b=inst[1])     # hot loop, continue compiled
+                pc = inst[1]
+            elif op == JZ:
+                if r[inst[1]] == 0:
+                    pc = inst[2]
+            elif op == INC:
+                r[inst[1]] = wrap64(r[inst[1]] + 1)
+            elif op == CALL:
+                r[inst[2]] = self.ns[f"F{inst[1]}"](*[v if imm else r[v] for imm, v in inst[3]])
+            elif op == RET:
+                return r[inst[1]]
+            elif op == RETI:
+                return inst[1]
+            elif op == BINK:
+                r[inst[2]] = inst[1](inst[3], r[inst[4]])
+            elif op == UN:
+                r[inst[2]] = inst[1](r[inst[3]])
+            elif op == JNZ:
+                if r[inst[1]] != 0:
+                    pc = inst[2]
+            elif op == DEC:
+                r[inst[1]] = wrap64(r[inst[1]] - 1)
+            elif op == PRINT:
+                print(f">>> {r[inst[1]]}")
+            elif op == PRINTS:
+                print(f">>> {inst[1]}")
+            else:
+                print(f"invalid opcode: {inst[1]}")
+                raise Halt
+
+    def run(self):
+        """ on a thread whose C stack has room for max_depth interpreted calls, the main one may not """
+        errors = []
+        def main():
+            try:
+                self._run()
+            except BaseException as e:
+                errors.append(e)
+        size = threading.stack_size()
+        threading.stack_size(max(16 << 20, self.max_depth * _CALL_STACK))
+        try:
+            thread = threading.Thread(target=main)
+            thread.start()
+            thread.join()
+        finally:
+            threading.stack_size(size)
+        if errors:
+            raise errors[0]
+
+    def _run(self):
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(limit + 3 * self.max_depth)  # an interpreted call takes 3 python frames
+        print("start!")
+        try:
+            self.call(self.index["main"], ())
+        except Halt:
+            pass
+        except RecursionError:
+            raise pcode.StackOverflow(f"stack overflow: more than about {self.max_depth} nested calls") from None
+        finally:
+            sys.setrecursionlimit(limit)
+        print("finish!")
+
+
+if __name__ == "__main__":
+    import argparse
+    cli = argparse.ArgumentParser(description="run a pcode program with the tier-up JIT")
+    cli.add_argument("file", nargs="?", default="c/tinyc.asm", help=".asm or .tcb")
+    cli.add_argument("--threshold", type=int, default=100, help="calls + loop iterations before a function is compiled")
+    cli.add_argument("--interpret", action="store_true", help="never compile")
+    cli.add_argument("--dump", action="store_true", help="print the python source of the compiled functions")
+    cli.add_argument("--max-depth", type=int, default=10000, help="nested calls before it stops with a stack overflow")
+    args = cli.parse_args()
+
+    p = JitProgram(pcode.Program(args.file, max_depth=args.max_depth), threshold=args.threshold,
+                   interpret=args.interpret)
+    try:
+        p.run()
+    except pcode.StackOverflow as e:
+        print(e)
+        sys.exit(1)
+    if args.dump:
+        for src in p.sources.values():
+            print(src)
@@ -0,0 +1,151 @@
+"""
+linker: merges object files into one runnable program
+
+    .tco pcode objects of tinyc.py -c   ->  .tcb bytecode, run by pcode.py and the other vms
+    .o objects of asm.py -c             ->  raw memory image .bin, run by test.py
+
+the objects are laid out one after the other, in the order they are given. a
+symbol is a function of a .tco or a .globl tag of a .o, and exactly one object
+defines it. the pc operands of a .tco move with it, a call of a function of
+another module gets that function's pc. a .o starts at a 4-byte boundary, its
+relocations are encoded again at their final address, with its own tags first
+and then the exported ones; execution starts at address 0, the first object
+
+only a changed module is compiled again, the others come out of the build cache:
+
+    python tinyc.py -c main.c lib.c
+    python link.py main.tco lib.tco -o prog.tcb --run
+"""
+import os
+import sys
+import argparse
+import logging
+import asm
+import tcb
+
+
+def link_pcode(paths: list):
+    """ .tco files -> (insts, lines, tags) for tcb.write(), None on error """
+    objects = [tcb.load_object(path) for path in paths]
+    ok = True
+    symbols = {}                                        # name -> (pc, path)
+    bases = []
+    base = 0
+    for path, (insts, lines, tags, relocs) in zip(paths, objects):
+        bases.append(base)
+        for name, pc in tags.items():
+            if name in symbols:
+                print(f"[error] {name} is defined in {symbols[name][1]} and {path}")
+                ok = False
+            symbols[name] = (base + pc, path)
+        base += len(insts)
+    if "main" not in symbols:
+        print("[error] no main function")
+        ok = False
+
+    code = []
+    srclines = []
+    for path, base, (insts, lines, tags, relocs) in zip(paths, bases, objects):
+        insts = list(insts)
+        for pc, symbol in relocs:
+            opcode, operand = insts[pc]
+            if symbol is None:
+                insts[pc] = (opcode, base + operand)
+            elif symbol in symbols:
+                insts[pc] = (opcode, symbols[symbol][0])
+            else:
+                print(f"[error] undefined function {symbol}, called in {path}")
+                ok = False
+        code += insts
+        srclines += lines
+    if not ok:
+        return None
+    return code, srclines, {name: pc for name, (pc, _) in symbols.items()}
+
+def link_asm(paths: list):
+    """ .o files -> (image, tags): the memory image and the exported tags, None on error """
+    objects = [asm.load_object(path) for path in paths]
+    ok = True
+    symbols = {}                                        # name -> (address, path)
+    bases = []
+    base = 0
+    for path, (image, tags, exports, relocs) in zip(paths, objects):
+        base = (base + 3) >> 2 << 2                     # aligned 4 bytes
+        bases.append(base)
+        for name in exports:
+            if name in symbols:
+                print(f"[error] {name} is exported by {symbols[name][1]} and {path}")
+                ok = False
+            symbols[name] = (base + tags[name], path)
+        base += len(image)
+
+    out = bytearray(base)
+    errors = asm.errors
+    exported = {name: addr for name, (addr, _) in symbols.items()}
+    for path, base, (image, tags, exports, relocs) in zip(paths, bases, objects):
+        out[base:base + len(image)] = image
+        scope = dict(exported)
+        scope.update((name, base + addr) for name, addr in tags.items())
+        for addr, N, content in relocs:
+            unit = asm.Unit(content, N, base + addr)
+            missing = [s for s in unit.symbols() if s not in scope]
+            if missing:
+                print(f"[error] undefined tag {missing[0]}, used in {path} line {N}")
+                ok = False
+                continue
+            unit.decode(scope, out)
+    if not ok or asm.errors != errors:                  # asm.py logged why
+        return None
+    return out, exported
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="link object files into one program")
+    cli.add_argument("files", nargs="+", help=".tco objects of tinyc.py -c, or .o objects of asm.py -c")
+    cli.add_argument("-o", help="output, default: the first file with .tcb or .bin")
+    cli.add_argument("--run", action="store_true", help="run it on pcode.py, or on test.py")
+    args = cli.parse_args()
+    asm.logger.setLevel(logging.INFO)
+    asm.logger.addHandler(logging.StreamHandler())
+
+    kinds = {os.path.splitext(path)[1] for path in args.files}
+    if kinds not in [{".tco"}, {".o"}]:
+        print("[error] link either .tco or .o objects")
+        sys.exit(1)
+    pcode_objects = kinds == {".tco"}
+    out = args.o or os.path.splitext(args.files[0])[0] + (".tcb" if pcode_objects else ".bin")
+    try:
+        linked = link_pcode(args.files) if pcode_objects else link_asm(args.files)
+    except (OSError, ValueError) as e:
+        print(f"[error] {e}")
+        sys.exit(1)
+    if linked is None:
+        sys.exit(1)
+
+    if pcode_objects:
+        insts, lines, tags = linked
+        tcb.write(out, insts, lines, tags)
+        print(f"{len(args.files)} objects, {len(tags)} functions, {len(insts)} instructions -> {out}")
+    else:
+        image, tags = linked
+        with open(out, 'wb') as f:
+            f.write(image)
+        print(f"{len(args.files)} objects, {len(tags)} exported tags, {len(image)} bytes -> {out}")
+    if not args.run:
+        sys.exit(0)
+
+    import logs
+    logs._init()
+    if pcode_objects:
+        import pcode
+        try:
+            pcode.Program(out).run()
+        except pcode.StackOverflow as e:
+            print(e)
+            sys.exit(1)
+    else:
+        import test
+        cpu = test.Cpu()
+        cpu.load_program(out)
+        cpu.run()
+        sys.exit(cpu.exit_code)
@@ -0,0 +1,47 @@
+"""
+operators of the tinyc pcode, shared by the compiler and every backend
+
+    binary_ops: name -> f(a, b)      a is the deeper stack slot, b the top 
+    unary_ops:  name -> f(a)
+
+all values are signed 64-bit 2's complement integers, results are wrapped
+"""
+
+MASK64 = (1 << 64) - 1
+SIGN64 = 1 << 63
+
+def wrap64(x: int) -> int:
+    """ wrap a python int to a signed 64-bit 2's complement value """
+    return ((x + SIGN64) & MASK64) - SIGN64
+
+def c_div(a: int, b: int) -> int:
+    """ C division, truncated towards zero """
+    q = abs(a) // abs(b)
+    return wrap64(q if (a < 0) == (b < 0) else -q)
+
+def c_mod(a: int, b: int) -> int:
+    """ C remainder, has the sign of the dividend """
+    q = abs(a) // abs(b)
+    return wrap64(a - b * (q if (a < 0) == (b < 0) else -q))
+
+
+binary_ops = {
+    'op_add': lambda a, b: wrap64(a + b),
+    'op_sub': lambda a, b: wrap64(a - b),
+    'op_mul': lambda a, b: wrap64(a * b),
+    'op_div': c_div,
+    'op_mod': c_mod,
+    'op_and': lambda a, b: a & b,
+    'op_or':  lambda a, b: a | b,
+    'cmp_eq': lambda a, b: int(a == b),
+    'cmp_ne': lambda a, b: int(a != b),
+    'cmp_gt': lambda a, b: int(a > b),
+    'cmp_lt': lambda a, b: int(a < b),
+    'cmp_ge': lambda a, b: int(a >= b),
+    'cmp_le': lambda a, b: int(a <= b),
+}
+
+unary_ops = {
+    'op_not': lambda a: ~a,
+    'op_neg': lambda a: wrap64(-a),
+}
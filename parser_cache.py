@@ -0,0 +1,91 @@
+"""
+persistent cache of analysed Lark parsers
+
+a built Lark object is saved into cache_dir, keyed on a hash of the grammar
+text and of the parser options (plus the lark and python versions). when the
+grammar changes the key changes, and the stale entries of that parser are removed
+
+LALR parsers use Lark's own serialization (Lark.save / Lark.load), lark 0.11
+cannot serialize Earley parsers, those are pickled
+
+    cache_dir/<name>-<options hash>-<grammar hash>.pickle
+
+set TINYC_CACHE_DIR to move the cache, or to an empty string to disable it
+"""
+import io
+import os
+import sys
+import hashlib
+import importlib
+import pickle
+import types
+import lark
+from lark import Lark
+
+
+cache_dir = os.environ.get("TINYC_CACHE_DIR",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tinyc_cache"))
+
+_parsers = {}       # key -> Lark, parsers already loaded by this process
+_saved = {}         # key -> Lark.save() of a LALR parser
+
+
+class _Pickler(pickle.Pickler):
+    """ the lexer config keeps a reference to the re module, pickle modules by name """
+    def reducer_override(self, obj):
+        if isinstance(obj, types.ModuleType):
+            return importlib.import_module, (obj.__name__,)
+        return NotImplemented
+
+
+def _hash(s: str) -> str:
+    return hashlib.sha256(s.encode('utf8')).hexdigest()[:16]
+
+def load_parser(name: str, grammar: str, transformer=None, **options) -> Lark:
+    """ 
+    Lark(grammar, **options), loaded from the cache when the grammar is unchanged
+    an inline transformer (LALR only) is not part of the key: the cached parser 
+    is copied and the transformer is attached to the copy
+    """
+    prefix = f"{name}-{_hash(repr(sorted(options.items())) + lark.__version__ + sys.version)}-"
+    key = prefix + _hash(grammar)
+    if transformer is not None:
+        if key not in _saved:
+            f = io.BytesIO()
+            load_parser(name, grammar, **options).save(f)
+            _saved[key] = f.getvalue()
+        return Lark.__new__(Lark)._load(io.BytesIO(_saved[key]), transformer=transformer)
+    if key in _parsers:
+        return _parsers[key]
+    if not cache_dir:
+        _parsers[key] = Lark(grammar, **options)
+        return _parsers[key]
+
+    path = os.path.join(cache_dir, key + ".pickle")
+    lalr = options.get("parser") == "lalr"
+    try:
+        with open(path, 'rb') as f:
+            _parsers[key] = Lark.load(f) if lalr else pickle.load(f)
+            return _parsers[key]
+    except FileNotFoundError:
+        pass
+    except Exception as e:                      # broken entry, rebuild it
+        print(f"[warning] parser cache {path}: {e}")
+
+    parser = Lark(grammar, **options)
+    _parsers[key] = parser
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for old in os.listdir(cache_dir):       # same parser, old grammar
+            if old.startswith(prefix) and old.endswith(".pickle"):
+                os.remove(os.path.join(cache_dir, old))
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            if lalr:
+                parser.save(f)
+            else:
+                _Pickler(f, pickle.HIGHEST_PROTOCOL).dump(parser)
+        os.replace(tmp, path)                   # atomic, other processes never see half a file
+    except OSError as e:
+        print(f"[warning] cannot write parser cache {path}: {e}")
+    return parser
@@ -1,13 +1,16 @@
 import sys
 import re
 import logs
-from lark import Lark, Token, Tree
+import tcb
+from ops import wrap64, binary_ops, unary_ops
+from lark import Token, Tree
+from parser_cache import load_parser
 
 
 grammar = r"""
-program:  function (_WS_NEWLINE function)* 
+program:  function+ 
 
-function: "def" _WS_INLINE  funcname [_WS_INLINE] ":"  (_WS_NEWLINE line)+
+function: "def" _WS_INLINE  funcname [_WS_INLINE] ":"  (_WS_NEWLINE line)* [_WS_NEWLINE]
 
 funcname: NAME
 
@@ -20,7 +23,7 @@ funcname: NAME
 
 NAME: /[a-zA-Z][_a-zA-Z0-9]*/
 STRING: /".*?(?<!\\)"/
-INTEGER: /\d+/ | /0x[\da-f]+/i | /0b[01]+/i
+INTEGER: /-?\d+/ | /0x[\da-f]+/i | /0b[01]+/i
 TAG: /_[_a-zA-Z0-9]*/
 
 _WS_INLINE: /[ \t]+/ 
@@ -28,27 +31,52 @@ _COMMENT:   /\/\/.*/
 _WS_NEWLINE.2: (/\s/|_COMMENT)* /[\r\n]/ (/\s/|_COMMENT)*
 
 """
-pcode_parser = Lark(grammar, start="program", lexer="standard")
+
+def get_parser(earley=False):
+    """ LALR(1) with a contextual lexer, or the slower Earley parser as a fallback """
+    if earley:
+        return load_parser("pcode", grammar, start="program", lexer="standard")
+    return load_parser("pcode", grammar, start="program", parser="lalr", lexer="contextual")
+
+def tree_from_pcodes(pcodes: list):
+    """ 
+    the tree the grammar gives for a list of (pcode, line) from tinyc.GenPcode
+    and {token.line: line}, without formatting and parsing them
+    """
+    functions = []
+    srclines = {}
+    for i, (s, n) in enumerate(pcodes):
+        srclines[i] = n 
+        s = s.strip()
+        if s.startswith("def "):
+            name = s[4:-1].strip()
+            functions.append(Tree("function", [Tree("funcname", [Token("NAME", name, line=i)])]))
+            continue
+        lines = functions[-1].children 
+        parts = s.split(None, 1)
+        token = Token("NAME", parts[0], line=i)
+        if s[0] == "_":
+            lines.append(Tree("linetag", [Token("TAG", s, line=i)]))
+        elif s[0] == "@":
+            lines.append(Tree("funcall", [Token("NAME", s[1:], line=i)]))
+        elif parts[0] == "print":
+            arg = parts[1]
+            lines.append(Tree("printstmt", [Token("STRING" if arg[0] == '"' else "NAME", arg, line=i)]))
+        elif len(parts) == 1:
+            lines.append(Tree("opstmt", [token]))
+        elif parts[1][0] == "_":
+            lines.append(Tree("jmpstmt", [token, Token("TAG", parts[1], line=i)]))
+        elif parts[1][0].isalpha():
+            lines.append(Tree("opstmt", [token, Token("NAME", parts[1], line=i)]))
+        else:
+            lines.append(Tree("opstmt", [token, Token("INTEGER", parts[1], line=i)]))
+    return Tree("program", functions), srclines
 
 # print = logs.error
 
-class int64:
-    def __init__(self, x:int = 0):
-        self.x = x
-    def __repr__(self):
-        return str(self.x)
-    def __eq__(self, i):
-        return int64(self.x == i.x)
-    def __lt__(self, i):
-        return int64(self.x < i.x)
-    def __add__(self, i):
-        return int64(self.x + i.x)
-    def __or__(self, i):
-        return int64(self.x | i.x)    
-    def __neg__(self):
-        return int64(-self.x)  
-    def __mul__(self, i):
-        return int64(self.x * i.x)  
+class StackOverflow(RuntimeError):
+    """ more nested calls than Program.max_depth """
+
 
 class Program: 
     """stack: 
@@ -61,12 +89,40 @@ class Program:
             var1 
             var2
     """
-    def __init__(self, filename:str):
-
-        with open(filename, 'r', encoding='utf8') as f:
-            code = f.read().strip()
+    def __init__(self, filename:str = None, earley=False, pcodes:list = None, max_depth:int = 10000,
+                 relocatable=False):
+        """ 
+        load a pcode file (.asm), a bytecode file (.tcb), 
+        or the pcodes of tinyc.GenPcode without writing them to a file 
+        max_depth: nested calls before run() raises StackOverflow
+        relocatable: one module of a program, it may call functions it does not define (self.imports), 
+                     written as an object file by tinyc.py -c and linked by link.py
+        """
+        self.pc = 0                     # initial pc 
+        self.ebp = 0                    # base stack pointer
+        self.stack = []      
+        self.depth = 0                  # nested calls
+        self.max_depth = max_depth
+        self.relocatable = relocatable
+        self.imports = {}               # pc -> name of the function it calls, not in this module
+
+        if pcodes is None and filename.endswith((".tcb", ".tco")):      # tcb.load() refuses a .tco object
+            self.insts, self.lines, self.tags = tcb.load(filename)
+            self.decode()               # instructions -> (handler, operand)
+            return 
+
+        if pcodes is None:
+            with open(filename, 'r', encoding='utf8') as f:
+                code = f.read().strip() + "\n"        # a trailing comment needs its newline
+            self.tree = get_parser(earley).parse(code)
+            self.srclines = {}          # token.line -> line in the tinyc source
+            for i, line in enumerate(code.split('\n')):
+                r = re.search(r'// line: (\d+)', line)
+                if r:
+                    self.srclines[i + 1] = int(r.groups()[0])
+        else:
+            self.tree, self.srclines = tree_from_pcodes(pcodes)
 
-        self.tree = pcode_parser.parse(code)
         self.preprocess_func()          # add some inst
 
         self.tags = {}                  # tag_name -> bin location
@@ -74,18 +130,17 @@ class Program:
 
         self.pcode = []                 # instructions 
         self.preprocess_names()         # arg_name -> stack location
-
-        self.pc = int64()               # initial pc 
-        self.ebp = int64()              # base stack pointer
-        self.addr = int64()             # return address    
-        self.stack = []      
+        self.lower()                    # instructions -> (opcode, operand)
+        self.decode()                   # (opcode, operand) -> (handler, operand)
 
     def preprocess_func(self):
         """
         funcall:  
-            push ret_value; push a; push b; push ebp; push pc+1; stack.size -> ebp; jmp func
+            push ret_value; push a; push b; call func
+            call: push ebp; push pc+1; stack.size -> ebp; jmp func
         ret: 
-            stack.resize(ebp); pop addr;  pop ebp; pop a; pop b; jmp addr
+            ret n_args
+            ret: pop -> ret_value; pop addr; pop ebp; stack.resize(ret_value+1); jmp addr
         """
         for func in self.tree.children:
             children_new = []
@@ -95,18 +150,11 @@ class Program:
                     func_name = line.children[0].value
                     children_new.append(Tree("linetag",[Token("TAG", func_name)]))
                 elif line.data == "funcall":
-                    func_name = line.children[0].value
-                    children_new.append(Tree("opstmt", [Token("NAME", "push"), Token("REG", "@ebp")]))
-                    # push pc+1;  stack.size -> ebp; jmp func
-                    children_new.append(Tree("jmpstmt", [Token("NAME", "jal"), Token("TAG", func_name)]))
+                    func_name = line.children[0]
+                    children_new.append(Tree("jmpstmt", [Token.new_borrow_pos("NAME", "call", func_name), 
+                                                         Token("TAG", func_name.value)]))
                 elif line.data == "opstmt" and line.children[0] == "ret":
-                    children_new.append(Tree("opstmt", [Token("NAME", "pop"), Token("ARG", -3-func.n_args)]))
-                    children_new.append(Tree("stack", [Token("NAME", "resize")]))
-                    children_new.append(Tree("opstmt", [Token("NAME", "pop"), Token("REG", "@addr")]))
-                    children_new.append(Tree("opstmt", [Token("NAME", "pop"), Token("REG", "@ebp")]))
-                    for i in range(func.n_args):
-                        children_new.append(Tree("opstmt", [Token("NAME", "pop")]))
-                    children_new.append(Tree("opstmt", [Token("NAME", "jmp"), Token("REG", "@addr")]))
+                    children_new.append(Tree("opstmt", [line.children[0], Token("NARGS", func.n_args)]))
                 else: 
                     children_new.append(line)
                     if line.data == "opstmt" and line.children[0] == "arg":
@@ -114,12 +162,17 @@ class Program:
             func.children = children_new
 
     def preprocess_tags(self):
+        """
+        every var is a push 0 at the entry of its function, after the function tag: a var declared
+        in a block would otherwise leave a different stack depth on each path through the block
+        """
         n_inst = 0
         for func in self.tree.children:
-            children_new = []
             func.args = {}
             curr_arg = -2
             curr_var = 0
+            pushes = []
+            body = []
             for line in func.children:
                 if line.data == "opstmt" and line.children[0] == "arg":
                     func.args[line.children[1].value] = curr_arg - func.n_args
@@ -127,140 +180,369 @@ class Program:
                 elif line.data == "opstmt" and line.children[0] == "var":
                     func.args[line.children[1].value] = curr_var
                     curr_var += 1 
-                    children_new.append(Tree("opstmt", [Token("NAME", "push"), Token("INTEGER", "0")]))
-                    n_inst += 1 
-                elif line.data == "linetag":
+                    pushes.append(Tree("opstmt", [Token.new_borrow_pos("NAME", "push", line.children[0]), 
+                                                  Token("INTEGER", "0")]))
+                else:
+                    body.append(line)
+
+            children_new = []
+            for line in body[:1] + pushes + body[1:]:       # body[0] is the function tag
+                if line.data == "linetag":
                     self.tags[line.children[0].value] = n_inst 
                 else:
                     children_new.append(line)
                     n_inst += 1 
-
             func.children = children_new
             
     def preprocess_names(self):
         for func in self.tree.children:
             for line in func.children:
                 if line.data == "jmpstmt":
-                    line.children[1].value = self.tags[line.children[1]] 
+                    target = line.children[1]
+                    if self.relocatable and target not in self.tags and line.children[0] == "call":
+                        self.imports[len(self.pcode)] = target.value
+                        target.value = 0                    # by the linker
+                    else:
+                        target.value = self.tags[target] 
                 elif line.data == "opstmt" and len(line.children) > 1:
                     if line.children[1].type == "NAME":
                         line.children[1] = Token("ARG", func.args[line.children[1]])
                     elif line.children[1].type == "INTEGER":
-                        line.children[1].value = int64(int(line.children[1].value))
+                        line.children[1].value = wrap64(int(line.children[1].value))
                 elif line.data == "printstmt" and line.children[0].type == "NAME":
-                    line.children[0] = Token("ARG", func.args[line.children[0]])
+                    line.children[0] = Token.new_borrow_pos("ARG", func.args[line.children[0]], line.children[0])
 
                 self.pcode.append(line)
-                
-
-    def op_push(self, args: list):
-        val = self._getvalue(args[1])
-        self.stack.append(int64(val.x))
-
-    def op_pop(self, args:list):
-        a = self.stack.pop()
-        if len(args) > 1:
-            self._getvalue(args[1]).x = a.x
-
-    def op_stack(self, args:list):
-        if args[0] == "resize":
-            self.stack = self.stack[:self.ebp.x]   # ebp -> esp
-        else: 
-            print(f"invalid stack operation {args[0]}")
-            
-    def op_op_add(self, args: list):
-        self.stack.append(self.stack.pop()+self.stack.pop())
-    def op_op_sub(self, args: list):
-        self.stack.append(-self.stack.pop()+self.stack.pop())
-    def op_op_or(self, args: list):
-        self.stack.append(self.stack.pop()|self.stack.pop())
-    def op_op_mul(self, args: list):
-        self.stack.append(self.stack.pop()*self.stack.pop())
-
-    def op_cmp_lt(self, args: list):
-        b = self.stack.pop()
-        a = self.stack.pop()
-        self.stack.append(a < b)
-
-    def op_cmp_eq(self, args: list):
-        self.stack.append(self.stack.pop() == self.stack.pop())
-
-    def op_jz(self, args: list):
-        if self.stack.pop().x == 0:
-            self.pc.x = self._getvalue(args[1]).x   # tag or reg
+
+    def lower(self):
+        """ 
+        the linked program as plain data, this is what a .tcb file stores
+            self.insts: [(opcode, operand)]     operand: int, str or None
+            self.lines: pc -> line in the tinyc source, None if unknown
+        an operator of the ops table is part of the opcode: "binary:op_add", "binary_jz:cmp_lt"
+        """
+        self.insts = []
+        self.lines = []
+        for inst in self.pcode:
+            self.insts.append(self._lower(inst))
+            self.lines.append(self.srclines.get(inst.children[0].line))
+
+    def _lower(self, inst: Tree):
+        """ Tree -> (opcode, operand) """
+        token = inst.children[0]
+        if inst.data == "printstmt":
+            return ("print_str" if token.type == "STRING" else "print_arg"), token.value
+        if inst.data == "jmpstmt":                          # jz, jmp, call: operand is a pc
+            if token.endswith("_jz") and token[:-3] in binary_ops:
+                return "binary_jz:" + token[:-3], inst.children[1].value
+            return token.value, inst.children[1].value
+        if len(inst.children) == 1:
+            if token in binary_ops:
+                return "binary:" + token, None
+            if token in unary_ops:
+                return "unary:" + token, None
+            return token.value, None
+        operand = inst.children[1]
+        if token == "push" and operand.type == "INTEGER":
+            return "push_immd", operand.value
+        if token in ["push", "pop"] and operand.type == "ARG":
+            return token + "_arg", operand.value
+        if token in binary_ops:                             # push x; op -> op x
+            if operand.type == "ARG":
+                return "binary_arg:" + token, operand.value
+            return "binary_immd:" + token, operand.value
+        return token.value, operand.value
+
+    def exports(self) -> dict:
+        """ function name -> pc """
+        return {name: pc for name, pc in self.tags.items() if name[0] != "_"}
+
+    def relocations(self) -> list:
+        """ [(pc, symbol)] of the instructions whose operand is a pc: the imported function, or None """
+        return [(pc, self.imports.get(pc)) for pc, (opcode, _) in enumerate(self.insts)
+                if opcode in ["jz", "jnz", "jmp", "call"] or opcode.startswith("binary_jz:")]
+
+    def decode(self):
+        """ 
+        bind every instruction to a (handler, operand) pair once, so the 
+        dispatch loop does no string building, tree inspection or attribute lookup 
+        """
+        self.code = []                  # [(handler, operand)]
+        handlers = {}                   # opcode -> (handler, f)
+        invalid = self.op_invalid
+        for opcode, operand in self.insts:
+            if opcode not in handlers:
+                name, _, op = opcode.partition(":")
+                handler = getattr(self, "op_" + name, None)
+                f = binary_ops.get(op) or unary_ops.get(op)
+                if handler is None or (op and f is None):
+                    handler = invalid
+                handlers[opcode] = (handler, f)
+            handler, f = handlers[opcode]
+            if handler is invalid:
+                operand = opcode
+            elif f is not None:
+                operand = f if operand is None else (f, operand)
+            self.code.append((handler, operand))
+
+    def op_push_immd(self, val: int):
+        self.stack.append(val)
+
+    def op_push_arg(self, offset: int):
+        self.stack.append(self.stack[self.ebp + offset])
+
+    def op_pop(self, _):
+        self.stack.pop()
+
+    def op_pop_arg(self, offset: int):
+        self.stack[self.ebp + offset] = self.stack.pop()
+
+    def op_binary(self, f):
+        stack = self.stack
+        b = stack.pop()
+        stack[-1] = f(stack[-1], b)
+
+    def op_unary(self, f):
+        stack = self.stack
+        stack[-1] = f(stack[-1])
+
+    def op_binary_arg(self, operand):
+        f, offset = operand
+        stack = self.stack
+        stack[-1] = f(stack[-1], stack[self.ebp + offset])
+
+    def op_binary_immd(self, operand):
+        f, val = operand
+        stack = self.stack
+        stack[-1] = f(stack[-1], val)
+
+    def op_binary_jz(self, operand):
+        f, target = operand
+        stack = self.stack
+        b = stack.pop()
+        if f(stack.pop(), b) == 0:
+            self.pc = target
+
+    def op_inc(self, offset: int):
+        stack = self.stack
+        i = self.ebp + offset
+        stack[i] = wrap64(stack[i] + 1)
+
+    def op_dec(self, offset: int):
+        stack = self.stack
+        i = self.ebp + offset
+        stack[i] = wrap64(stack[i] - 1)
+
+    def op_jz(self, target: int):
+        if self.stack.pop() == 0:
+            self.pc = target
+
+    def op_jnz(self, target: int):
+        if self.stack.pop() != 0:
+            self.pc = target
     
-    def op_jmp(self, args: list):
-        self.pc.x = self._getvalue(args[1]).x       # tag or reg
-
-    def op_jal(self, args: list):
-        self.stack.append(int64(self.pc.x))
-        self.ebp.x = len(self.stack)
-        self.pc.x = self._getvalue(args[1]).x       # tag
-
-    def op_print(self, args:list):
-        token = args[0]
-        if token.type == "STRING":
-            print(f">>> {token.value}")
-        elif token.type == "ARG":
-            i = self._getvalue(token).x
-            print(f">>> {i}")
-
-    def run(self):
-        self.stack = [int64(-1), int64(0), int64(-1)]       # return value; init_ebp;  return address;
-        self.ebp.x = 3                                      # main_ebp  
-        self.pc.x = self.tags["main"]                       # jmp
+    def op_jmp(self, target: int):
+        self.pc = target
+
+    def overflow(self, pc: int):
+        line = self.lines[pc - 1] if 0 < pc <= len(self.lines) else None
+        raise StackOverflow(f"stack overflow: more than {self.max_depth} nested calls"
+                            + (f" at line {line}" if line else f" at pc {pc - 1}"))
+
+    def op_call(self, target: int):
+        if self.depth >= self.max_depth:
+            self.overflow(self.pc)
+        self.depth += 1
+        self.stack.append(self.ebp)
+        self.stack.append(self.pc)
+        self.ebp = len(self.stack)
+        self.pc = target
+
+    def op_ret(self, n_args: int):
+        stack = self.stack
+        ebp = self.ebp
+        ret = ebp - 3 - n_args                              # ret_value
+        stack[ret] = stack.pop()
+        self.pc = stack[ebp - 1]
+        self.ebp = stack[ebp - 2]
+        del stack[ret + 1:]                                 # in place, the frame only
+        self.depth -= 1
+
+    def op_print_str(self, s: str):
+        print(f">>> {s}")
+
+    def op_print_arg(self, offset: int):
+        print(f">>> {self.stack[self.ebp + offset]}")
+
+    def op_invalid(self, opcode: str):
+        print(f"invalid opcode: {opcode}")
+        self.pc = -1
+
+    def thread(self) -> list:
+        """ 
+        threaded code: every instruction becomes a closure with its operand and its 
+        successor bound, it runs and returns the next pc, the dispatch loop is just
+            pc = fns[pc]()
+        the closures share the stack and ebp of this call, not the ones of self
+        """
+        stack = self.stack = [-1, 0, -1]                    # return value; init_ebp;  return address;
+        ebp = 3                                             # main_ebp
+        depth = 0
+        max_depth = self.max_depth
+        overflow = self.overflow
+
+        def push_immd(val, nxt):
+            def f():
+                stack.append(val)
+                return nxt
+            return f
+        def push_arg(offset, nxt):
+            def f():
+                stack.append(stack[ebp + offset])
+                return nxt
+            return f
+        def pop(_, nxt):
+            def f():
+                stack.pop()
+                return nxt
+            return f
+        def pop_arg(offset, nxt):
+            def f():
+                stack[ebp + offset] = stack.pop()
+                return nxt
+            return f
+        def binary(op, nxt):
+            def f():
+                b = stack.pop()
+                stack[-1] = op(stack[-1], b)
+                return nxt
+            return f
+        def unary(op, nxt):
+            def f():
+                stack[-1] = op(stack[-1])
+                return nxt
+            return f
+        def binary_arg(operand, nxt):
+            op, offset = operand
+            def f():
+                stack[-1] = op(stack[-1], stack[ebp + offset])
+                return nxt
+            return f
+        def binary_immd(operand, nxt):
+            op, val = operand
+            def f():
+                stack[-1] = op(stack[-1], val)
+                return nxt
+            return f
+        def binary_jz(operand, nxt):
+            op, target = operand
+            def f():
+                b = stack.pop()
+                return target if op(stack.pop(), b) == 0 else nxt
+            return f
+        def inc(offset, nxt):
+            def f():
+                stack[ebp + offset] = wrap64(stack[ebp + offset] + 1)
+                return nxt
+            return f
+        def dec(offset, nxt):
+            def f():
+                stack[ebp + offset] = wrap64(stack[ebp + offset] - 1)
+                return nxt
+            return f
+        def jz(target, nxt):
+            def f():
+                return target if stack.pop() == 0 else nxt
+            return f
+        def jnz(target, nxt):
+            def f():
+                return target if stack.pop() != 0 else nxt
+            return f
+        def jmp(target, nxt):
+            def f():
+                return target
+            return f
+        def call(target, nxt):
+            def f():
+                nonlocal ebp, depth
+                if depth >= max_depth:
+                    overflow(nxt)
+                depth += 1
+                stack.append(ebp)
+                stack.append(nxt)
+                ebp = len(stack)
+                return target
+            return f
+        def ret(n_args, nxt):
+            def f():
+                nonlocal ebp, depth
+                depth -= 1
+                top = ebp
+                r = top - 3 - n_args                        # ret_value
+                stack[r] = stack.pop()
+                ebp = stack[top - 2]
+                pc = stack[top - 1]
+                del stack[r + 1:]
+                return pc
+            return f
+        def print_str(s, nxt):
+            def f():
+                print(f">>> {s}")
+                return nxt
+            return f
+        def print_arg(offset, nxt):
+            def f():
+                print(f">>> {stack[ebp + offset]}")
+                return nxt
+            return f
+        def invalid(opcode, nxt):
+            def f():
+                print(f"invalid opcode: {opcode}")
+                return -1
+            return f
+
+        factories = locals()
+        fns = []
+        for pc, (handler, operand) in enumerate(self.code):
+            fns.append(factories[handler.__name__[3:]](operand, pc + 1))
+        return fns
+
+    def run(self, threaded=False):
+        if threaded:
+            fns = self.thread()
+            pc = self.tags["main"]
+            print("start!")
+            while pc >= 0:
+                pc = fns[pc]()
+            print("finish!")
+            return
+        self.stack = [-1, 0, -1]                            # return value; init_ebp;  return address;
+        self.ebp = 3                                        # main_ebp  
+        self.depth = 0
+        self.pc = self.tags["main"]                         # jmp
+        code = self.code
         print("start!")
-        while self.pc.x >= 0 and len(self.stack) < 5000:
-            self._run()
+        while self.pc >= 0:
+            handler, operand = code[self.pc]                # to trace a run see tracer.py
+            self.pc += 1 
+            handler(operand)
         print("finish!")
 
-    def _getvalue(self, token:Token):
-        if token.type == "INTEGER":
-            return int64(token.value.x)
-        elif token.type == "TAG":
-            return int64(token.value)
-        elif token.type == "ARG":
-            return self.stack[self.ebp.x + token.value]
-        elif token.type == "REG":
-            name = token.value[1:]
-            if hasattr(self, name):
-                ret = getattr(self, name)
-                if isinstance(ret, int64):
-                    return ret 
-            print(f"no such reg: {name}")
-        print(f"cannot get value of {token}")
-    
-
-    def _run(self):
-        inst = self.pcode[self.pc.x]
-        n = inst.children[0].line
-        # print("pc={:<4} ebp={:<4} esp={:<4} addr={:<4} line:{:<4} inst:{}".format(
-        #             self.pc.x, self.ebp.x, len(self.stack), self.addr.x, "" if n == None else n, inst))
-        self.pc.x += 1 
-        if inst.data in ["opstmt", "jmpstmt"]:
-            opcode = "op_" + inst.children[0].value
-        elif inst.data == "stack":
-            opcode = "op_stack"
-        elif inst.data == "printstmt":
-            opcode = "op_print"
-            
-        if hasattr(self, opcode):
-            getattr(self,opcode)(inst.children)
-        else:
-            print(f"invalid opcode: {opcode}")
-            self.pc.x = -1
-        # print(f"stack: {self.stack}")
-        
-
 
 if __name__ == "__main__":
     logs._init()
-    p = Program("c/tinyc.asm")
-    
+    max_depth = [int(arg.split("=")[1]) for arg in sys.argv if arg.startswith("--max-depth=")]
+    p = Program(sys.argv[1] if len(sys.argv) > 1 and sys.argv[1][0] != "-" else "c/tinyc.asm", 
+                earley="--earley" in sys.argv, max_depth=max_depth[-1] if max_depth else 10000)
+
     # for i in p.pcode:
     #     print(i)
 
-    p.run()
+    try:
+        p.run(threaded="--threaded" in sys.argv)
+    except StackOverflow as e:
+        print(e)
+        sys.exit(1)
 
     # cpu = Cpu(sys.argv[1])
 
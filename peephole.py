@@ -0,0 +1,159 @@
+"""
+peephole optimizer for the pcode emitted by tinyc.GenPcode
+
+works on GenPcode.pcodes, a list of (pcode, line), and rewrites short windows
+of instructions into shorter sequences or fused superinstructions:
+
+    jmp L; ...; L                   ->  L                   jmp_next
+    jmp L | ret; ...                ->  jmp L | ret         unreachable (var/arg are kept)
+    push k; jz L                    ->  jmp L | nothing     const_branch
+    push x; pop x                   ->  nothing             push_pop
+    push x; pop                     ->  nothing             push_pop
+    push x; push 1; op_add; pop x   ->  inc x               inc
+    push x; push 1; op_sub; pop x   ->  dec x               inc
+    cmp_lt; jz L                    ->  cmp_lt_jz L         cmp_jz
+    push x; op_add                  ->  op_add x            push_op     (push_var_add)
+
+tags and function headers are barriers, no window spans them
+"""
+from ops import binary_ops, wrap64
+
+
+def _inst(item):
+    """ (pcode, line) -> [op, arg] of an instruction, None for tags and function headers """
+    s = item[0].strip()
+    if s[0] == "_" or s[-1] == ":":
+        return None
+    parts = s.split(None, 1)
+    return [parts[0], parts[1] if len(parts) > 1 else None]
+
+def _is_tag(item):
+    return item[0][0] == "_"
+
+def _integer(arg):
+    """ integer value of a push operand as the VM sees it, wrapped to 64 bits; None for variables """
+    if arg is None or not (arg[0].isdigit() or arg[0] == "-"):
+        return None
+    try:
+        return wrap64(int(arg, 0))
+    except ValueError:
+        return wrap64(int(arg))
+
+def _line(items):
+    for _, n in items:
+        if n:
+            return n
+    return None
+
+def _rewrite(pcodes: list, k: int, f):
+    """ call f(window, items) on every window of k instructions, replace the items by its result unless None """
+    out = []
+    removed = 0
+    i = 0
+    while i < len(pcodes):
+        items = pcodes[i:i + k]
+        window = [_inst(item) for item in items]
+        new = None
+        if len(items) == k and None not in window:
+            new = f(window, items)
+        if new is None:
+            out.append(pcodes[i])
+            i += 1
+        else:
+            out.extend(new)
+            removed += k - len(new)
+            i += k
+    return out, removed
+
+
+def jmp_next(pcodes: list):
+    out = []
+    removed = 0
+    for i, item in enumerate(pcodes):
+        inst = _inst(item)
+        if inst and inst[0] == "jmp":
+            j = i + 1
+            while j < len(pcodes) and _is_tag(pcodes[j]) and pcodes[j][0].strip() != inst[1]:
+                j += 1
+            if j < len(pcodes) and _is_tag(pcodes[j]):
+                removed += 1
+                continue
+        out.append(item)
+    return out, removed
+
+def unreachable(pcodes: list):
+    """ declarations in dead code are kept: a var is function wide, the code after the tag may use it """
+    out = []
+    removed = 0
+    dead = False
+    for item in pcodes:
+        inst = _inst(item)
+        if inst is None:
+            dead = False
+        elif dead and inst[0] not in ["var", "arg"]:
+            removed += 1
+            continue
+        elif inst[0] in ["jmp", "ret"]:
+            dead = True
+        out.append(item)
+    return out, removed
+
+def const_branch(pcodes: list):
+    def f(w, items):
+        (push, k), (jmp, tag) = w
+        if push != "push" or jmp not in ["jz", "jnz"] or _integer(k) is None:
+            return None
+        if (_integer(k) == 0) == (jmp == "jz"):
+            return [(f"jmp {tag}", _line(items))]
+        return []
+    return _rewrite(pcodes, 2, f)
+
+def push_pop(pcodes: list):
+    def f(w, items):
+        (push, x), (pop, y) = w
+        if push == "push" and pop == "pop" and y in [x, None]:
+            return []
+        return None
+    return _rewrite(pcodes, 2, f)
+
+def inc(pcodes: list):
+    def f(w, items):
+        (push, x), (push1, one), (op, arg), (pop, y) = w
+        if (push, push1, pop) == ("push", "push", "pop") and x == y and _integer(x) is None and one == "1" and arg is None:
+            if op == "op_add":
+                return [(f"inc {x}", _line(items))]
+            if op == "op_sub":
+                return [(f"dec {x}", _line(items))]
+        return None
+    return _rewrite(pcodes, 4, f)
+
+def push_op(pcodes: list):
+    def f(w, items):
+        (push, x), (op, arg) = w
+        if push == "push" and x is not None and op in binary_ops and arg is None:
+            return [(f"{op} {x}", _line(items))]
+        return None
+    return _rewrite(pcodes, 2, f)
+
+def cmp_jz(pcodes: list):
+    def f(w, items):
+        (op, arg), (jz, tag) = w
+        if op.startswith("cmp_") and op in binary_ops and arg is None and jz == "jz":
+            return [(f"{op}_jz {tag}", _line(items))]
+        return None
+    return _rewrite(pcodes, 2, f)
+
+
+rules = [unreachable, jmp_next, const_branch, push_pop, inc, cmp_jz, push_op]
+
+def optimize(pcodes: list):
+    """ apply all rules until nothing changes, return (pcodes, {rule_name: n_removed}) """
+    report = {rule.__name__: 0 for rule in rules}
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules:
+            pcodes, removed = rule(pcodes)
+            report[rule.__name__] += removed
+            changed = changed or removed > 0
+    return pcodes, report
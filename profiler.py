@@ -0,0 +1,123 @@
+"""
+instruction profiler for the pcode VM
+
+runs a Program in its own dispatch loop (Program.run is not touched, so there is
+no cost when not profiling) and counts executed instructions:
+
+    per pc          every instruction
+    per line        line of the tinyc source, from the // line: annotations
+    per function    calls, exclusive and inclusive instructions
+    per call stack  "main;factor;factor 123", the collapsed format of flamegraph.pl
+
+    python profiler.py c/tinyc.asm [--top 20] [--collapsed out.folded]
+"""
+import argparse
+import bisect
+import collections
+import pcode
+
+
+class Profiler:
+    def __init__(self, program: pcode.Program):
+        self.program = program
+        funcs = sorted((pc, name) for name, pc in program.tags.items() if name[0] != "_")
+        self.starts = [pc for pc, _ in funcs]
+        self.names = [name for _, name in funcs]
+        self.counts = [0] * len(program.code)           # pc -> executed
+        self.collapsed = collections.Counter()          # call stack -> executed with it on top
+
+    def function(self, pc: int) -> str:
+        i = bisect.bisect_right(self.starts, pc) - 1
+        return self.names[i] if i >= 0 else "?"
+
+    def run(self):
+        p = self.program
+        code = p.code
+        counts = self.counts
+        collapsed = self.collapsed
+        kinds = [1 if handler.__name__ == "op_call" else 2 if handler.__name__ == "op_ret" else 0
+                 for handler, _ in code]
+        p.stack = [-1, 0, -1]
+        p.ebp = 3
+        p.depth = 0
+        p.pc = p.tags["main"]
+        path = ("main",)
+        n = mark = 0                                    # executed, executed at the last call or return
+        print("start!")
+        while p.pc >= 0:
+            pc = p.pc
+            handler, operand = code[pc]
+            counts[pc] += 1
+            n += 1
+            p.pc = pc + 1
+            handler(operand)
+            if kinds[pc]:
+                collapsed[path] += n - mark
+                mark = n
+                path = path + (self.function(operand),) if kinds[pc] == 1 else path[:-1]
+        print("finish!")
+
+    def functions(self) -> dict:
+        """ name -> [calls, exclusive, inclusive] """
+        stats = {name: [0, 0, 0] for name in self.names}
+        for pc, (opcode, operand) in enumerate(self.program.insts):
+            if opcode == "call" and self.counts[pc]:
+                stats[self.function(operand)][0] += self.counts[pc]
+        stats["main"][0] += 1
+        for path, n in self.collapsed.items():
+            stats[path[-1]][1] += n
+            for name in set(path):                      # recursion counts once
+                stats[name][2] += n
+        return stats
+
+    def report(self, top: int = 20):
+        insts = self.program.insts
+        lines = self.program.lines
+        total = sum(self.counts)
+        print(f"\n{total} instructions")
+
+        print("\n{:>10}{:>12}{:>12}{:>8}  {}".format("calls", "exclusive", "inclusive", "", "function"))
+        stats = sorted(self.functions().items(), key=lambda x: -x[1][2])
+        for name, (calls, excl, incl) in stats:
+            if calls:
+                print("{:>10}{:>12}{:>12}{:>7.1f}%  {}".format(calls, excl, incl, 100 * incl / total, name))
+
+        by_line = collections.Counter()
+        for pc, n in enumerate(self.counts):
+            if n and lines[pc]:
+                by_line[lines[pc]] += n
+        print("\n{:>10}{:>8}  {}".format("executed", "", "tinyc line"))
+        for line, n in by_line.most_common(top):
+            print("{:>10}{:>7.1f}%  {}".format(n, 100 * n / total, line))
+
+        print("\n{:>10}{:>8}  {}".format("executed", "", "pc"))
+        hot = sorted(range(len(self.counts)), key=lambda pc: -self.counts[pc])[:top]
+        for pc in hot:
+            if self.counts[pc]:
+                opcode, operand = insts[pc]
+                inst = opcode if operand is None else f"{opcode} {operand}"
+                print("{:>10}{:>7.1f}%  {:<6} {:<12} {}".format(
+                    self.counts[pc], 100 * self.counts[pc] / total, pc, self.function(pc), inst))
+
+    def write_collapsed(self, filepath: str):
+        """ one "main;f;g <instructions>" line per call stack, input of flamegraph.pl """
+        with open(filepath, 'w', encoding='utf8') as f:
+            for path, n in sorted(self.collapsed.items()):
+                f.write(f"{';'.join(path)} {n}\n")
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="profile a pcode program")
+    cli.add_argument("file", nargs="?", default="c/tinyc.asm", help=".asm or .tcb")
+    cli.add_argument("--top", type=int, default=20, help="rows of the line and pc tables")
+    cli.add_argument("--collapsed", help="write the collapsed call stacks to this file")
+    args = cli.parse_args()
+
+    prof = Profiler(pcode.Program(args.file))
+    try:
+        prof.run()
+    except pcode.StackOverflow as e:
+        print(e)
+    prof.report(args.top)
+    if args.collapsed:
+        prof.write_collapsed(args.collapsed)
@@ -0,0 +1,161 @@
+"""
+liveness analysis and linear-scan register allocation for the register code of regvm.py
+
+    liveness    live registers before and after every instruction, by backward
+                dataflow over the control flow graph, with bit sets
+    intervals   a register is live from its first definition to its last use,
+                in code order; a loop extends the interval over the whole loop
+    linear_scan Poletto and Sarkar: walk the intervals by start, free the ones
+                that ended, take a free machine register or spill the interval
+                that ends last
+
+args are defined on entry; a var that is read before it is written (regvm
+reads the register of a var that still holds its initial 0) is live on entry
+too, live_on_entry() tells the backend which ones to clear
+"""
+from regvm import (MOV, MOVI, BIN, BINI, BINK, UN, JMP, JZ, JNZ, BJZ, BJZI,
+                   INC, DEC, CALL, RET, RETI, PRINT, INVALID)
+
+
+def uses_defs(inst) -> tuple:
+    """ registers an instruction reads, registers it writes """
+    op = inst[0]
+    if op == MOV:
+        return [inst[2]], [inst[1]]
+    if op == MOVI:
+        return [], [inst[1]]
+    if op == BIN:
+        return [inst[3], inst[4]], [inst[2]]
+    if op in [BINI, UN]:
+        return [inst[3]], [inst[2]]
+    if op == BINK:
+        return [inst[4]], [inst[2]]
+    if op in [JZ, JNZ, RET, PRINT]:
+        return [inst[1]], []
+    if op == BJZ:
+        return [inst[2], inst[3]], []
+    if op == BJZI:
+        return [inst[2]], []
+    if op in [INC, DEC]:
+        return [inst[1]], [inst[1]]
+    if op == CALL:
+        return [v for is_imm, v in inst[3] if not is_imm], [inst[2]]
+    return [], []
+
+def successors(code: list, pc: int) -> list:
+    inst = code[pc]
+    op = inst[0]
+    if op == JMP:
+        return [inst[1]]
+    if op in [RET, RETI, INVALID]:
+        return []
+    succs = [pc + 1] if pc + 1 < len(code) else []
+    if op in [JZ, JNZ]:
+        succs.append(inst[2])
+    elif op in [BJZ, BJZI]:
+        succs.append(inst[4])
+    return succs
+
+
+def liveness(code: list) -> tuple:
+    """ -> (live_in, live_out): pc -> bit set of registers """
+    n = len(code)
+    use = [0] * n
+    kill = [0] * n
+    for pc, inst in enumerate(code):
+        uses, defs = uses_defs(inst)
+        for r in uses:
+            use[pc] |= 1 << r
+        for r in defs:
+            kill[pc] |= 1 << r
+    succs = [successors(code, pc) for pc in range(n)]
+    live_in = [0] * n
+    live_out = [0] * n
+    changed = True
+    while changed:
+        changed = False
+        for pc in range(n - 1, -1, -1):                 # backward, converges in a few rounds
+            out = 0
+            for s in succs[pc]:
+                out |= live_in[s]
+            new = use[pc] | (out & ~kill[pc])
+            if new != live_in[pc] or out != live_out[pc]:
+                live_in[pc] = new
+                live_out[pc] = out
+                changed = True
+    return live_in, live_out
+
+def _bits(x: int):
+    r = 0
+    while x:
+        if x & 1:
+            yield r
+        x >>= 1
+        r += 1
+
+
+def intervals(code: list, n_args: int) -> dict:
+    """ register -> [start, end] in code positions, the args start at -1 """
+    live_in, live_out = liveness(code)
+    spans = {}
+    def extend(r, pc):
+        if r in spans:
+            spans[r][0] = min(spans[r][0], pc)
+            spans[r][1] = max(spans[r][1], pc)
+        else:
+            spans[r] = [pc, pc]
+    for pc, inst in enumerate(code):
+        uses, defs = uses_defs(inst)
+        for r in uses + defs:
+            extend(r, pc)
+        for r in _bits(live_in[pc] | live_out[pc]):
+            extend(r, pc)
+    if code:
+        for r in _bits(live_in[0]):                      # args, and vars read before written
+            extend(r, -1)
+    for r in range(n_args):
+        if r in spans:
+            extend(r, -1)
+    return spans
+
+def live_on_entry(code: list) -> list:
+    return list(_bits(liveness(code)[0][0])) if code else []
+
+
+def linear_scan(code: list, n_args: int, registers: list, hints: dict = None) -> tuple:
+    """
+    -> ({register: machine register}, [spilled registers])
+    hints: register -> register whose machine register it would like (the source of a MOV)
+    """
+    spans = intervals(code, n_args)
+    order = sorted(spans, key=lambda r: (spans[r][0], spans[r][1]))
+    free = list(reversed(registers))                    # pop() takes registers in order
+    active = []                                         # sorted by end
+    assigned = {}
+    spilled = []
+    hints = hints or {}
+    for r in order:
+        start, end = spans[r]
+        expired = [a for a in active if spans[a][1] <= start and a != r]
+        for a in expired:                               # an instruction reads before it writes
+            active.remove(a)
+            free.append(assigned[a])
+        if free:
+            h = assigned.get(hints.get(r))
+            if h in free:
+                free.remove(h)
+                assigned[r] = h
+            else:
+                assigned[r] = free.pop()
+        else:
+            victim = max(active, key=lambda a: spans[a][1])
+            if spans[victim][1] > end:
+                assigned[r] = assigned.pop(victim)
+                active.remove(victim)
+                spilled.append(victim)
+            else:
+                spilled.append(r)
+                continue
+        active.append(r)
+        active.sort(key=lambda a: spans[a][1])
+    return assigned, spilled
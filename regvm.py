@@ -0,0 +1,355 @@
+"""
+register VM: runs the stack pcode of pcode.Program as three-address code
+
+every function gets a frame of virtual registers, laid out like its stack frame
+without the saved ebp and return address:
+
+    r[0 .. n_args-1]            args
+    r[n_args + i]               stack slot ebp+i: vars first, then expression temporaries
+
+the stack depth at every pc is known statically, so each stack slot is a fixed
+register. pushes are not executed, they are kept on a symbolic stack and become
+the operands of the instruction that consumes them; the result of an operation
+goes straight to the variable a following pop stores it to:
+
+    push s; push i; op_add; pop s       ->  BIN op_add, s, s, i
+    push i; push 10; cmp_lt; jz L       ->  BJZI cmp_lt, i, 10, L
+
+at jump targets and branches the symbolic stack is written to its registers
+"""
+import sys
+from ops import wrap64, binary_ops, unary_ops
+import pcode
+
+
+# opcodes of the register code
+(MOV, MOVI, BIN, BINI, BINK, UN, JMP, JZ, JNZ, BJZ, BJZI,
+ INC, DEC, CALL, RET, RETI, PRINT, PRINTS, INVALID) = range(19)
+
+names = ["MOV", "MOVI", "BIN", "BINI", "BINK", "UN", "JMP", "JZ", "JNZ", "BJZ", "BJZI",
+         "INC", "DEC", "CALL", "RET", "RETI", "PRINT", "PRINTS", "INVALID"]
+
+_branch = {JMP: 1, JZ: 2, JNZ: 2, BJZ: 4, BJZI: 4}      # opcode -> index of the target
+
+
+class Function:
+    def __init__(self, name: str, start: int, end: int, n_args: int):
+        self.name = name
+        self.start = start              # pc range in the stack code
+        self.end = end
+        self.n_args = n_args
+        self.n_regs = n_args
+        self.code = []                  # register code
+
+
+class RegisterProgram:
+    def __init__(self, program: pcode.Program):
+        self.insts = program.insts
+        self.max_depth = program.max_depth
+        starts = sorted((pc, name) for name, pc in program.tags.items() if name[0] != "_")
+        self.funcs = []
+        self.index = {}                 # name/start pc -> function index
+        for i, (start, name) in enumerate(starts):
+            end = starts[i + 1][0] if i + 1 < len(starts) else len(self.insts)
+            self.index[name] = self.index[start] = len(self.funcs)
+            self.funcs.append(Function(name, start, end, self._n_args(start, end)))
+        for func in self.funcs:
+            self.translate(func)
+
+    def _n_args(self, start: int, end: int) -> int:
+        """ from a ret, or from the lowest arg offset: args are at ebp-2-n_args .. ebp-3 """
+        lowest = -2
+        for opcode, operand in self.insts[start:end]:
+            if opcode == "ret":
+                return operand
+            if opcode in ["push_arg", "pop_arg", "print_arg", "inc", "dec"] or opcode.startswith("binary_arg:"):
+                lowest = min(lowest, operand)
+        return -2 - lowest
+
+    def _effect(self, opcode: str, operand):
+        """ -> (stack depth change, successors other than pc+1, falls through) """
+        name = opcode.partition(":")[0]
+        if name in ["push_immd", "push_arg"]:
+            return 1, [], True
+        if name in ["pop", "pop_arg", "binary"]:
+            return -1, [], True
+        if name in ["jz", "jnz"]:
+            return -1, [operand], True
+        if name == "binary_jz":
+            return -2, [operand], True
+        if name == "jmp":
+            return 0, [operand], False
+        if name == "call":
+            return -self.funcs[self.index[operand]].n_args, [], True
+        if name in ["ret", "invalid"] or name not in _known:
+            return 0, [], False
+        return 0, [], True
+
+    def depths(self, func: Function) -> dict:
+        """ pc -> stack depth above ebp, for every reachable pc """
+        depth = {func.start: 0}
+        work = [func.start]
+        while work:
+            pc = work.pop()
+            opcode, operand = self.insts[pc]
+            delta, succs, falls = self._effect(opcode, operand)
+            if falls:
+                succs = succs + [pc + 1]
+            for succ in succs:
+                if not func.start <= succ < func.end:
+                    raise ValueError(f"{func.name}: pc {pc} leaves the function")
+                if succ not in depth:
+                    depth[succ] = depth[pc] + delta
+                    work.append(succ)
+                elif depth[succ] != depth[pc] + delta:
+                    raise ValueError(f"{func.name}: stack depth differs at pc {succ}")
+        return depth
+
+    def translate(self, func: Function):
+        n = func.n_args
+        depth = self.depths(func)
+        func.n_regs = n + max(depth.values()) + 1
+        targets = set()
+        for pc in depth:
+            opcode, operand = self.insts[pc]
+            targets.update(self._effect(opcode, operand)[1])
+
+        code = func.code
+        at = {}                         # pc -> index in code
+        stack = []                      # symbolic stack: ("k", value) | ("r", register)
+        fresh = None                    # index of the instruction that computed the top temporary
+
+        def slot(offset):
+            return offset + n + 2 if offset < 0 else n + offset
+
+        def materialize(p):
+            kind, v = stack[p]
+            if (kind, v) != ("r", n + p):
+                code.append([MOVI if kind == "k" else MOV, n + p, v])
+                stack[p] = ("r", n + p)
+
+        def flush():
+            for p in range(len(stack)):
+                materialize(p)
+
+        def readers(reg):
+            """ positions that still have to read reg before it is written """
+            return [p for p, e in enumerate(stack) if e == ("r", reg) and n + p != reg]
+
+        def emit_bin(f, a, b):
+            """ push f(a, b) """
+            nonlocal fresh
+            d = n + len(stack)
+            if a[0] == "k" and b[0] == "k":
+                try:
+                    stack.append(("k", f(a[1], b[1])))
+                    return
+                except ZeroDivisionError:                   # leave it to runtime
+                    code.append([MOVI, d, a[1]])
+                    a = ("r", d)
+            if b[0] == "k":
+                code.append([BINI, f, d, a[1], b[1]])
+            elif a[0] == "k":
+                code.append([BINK, f, d, a[1], b[1]])
+            else:
+                code.append([BIN, f, d, a[1], b[1]])
+            stack.append(("r", d))
+            fresh = len(code) - 1
+
+        def emit_jz(f, a, b, target):
+            """ jump if not f(a, b) """
+            if a[0] == "k" and b[0] == "k":
+                if f(a[1], b[1]) == 0:
+                    code.append([JMP, target])
+                return
+            if a[0] == "k":
+                code.append([MOVI, n + len(stack), a[1]])
+                a = ("r", n + len(stack))
+            code.append([BJZI if b[0] == "k" else BJZ, f, a[1], b[1], target])
+
+        for pc in range(func.start, func.end):
+            if pc not in depth:                             # unreachable
+                continue
+            if pc in targets:
+                if pc - 1 in depth and self._effect(*self.insts[pc - 1])[2]:
+                    flush()                                 # falls into the target
+                stack = [("r", n + p) for p in range(depth[pc])]
+                fresh = None
+            at[pc] = len(code)
+            opcode, operand = self.insts[pc]
+            name, _, op = opcode.partition(":")
+
+            if name == "push_immd":
+                stack.append(("k", operand))
+            elif name == "push_arg":
+                stack.append(("r", slot(operand)))
+            elif name == "pop":
+                stack.pop()
+            elif name in ["pop_arg", "inc", "dec"]:
+                reg = slot(operand)
+                e = stack.pop() if name == "pop_arg" else None
+                p = len(stack)
+                if e == ("r", n + p) and fresh == len(code) - 1 and code[fresh][2] == n + p and not readers(reg):
+                    code[fresh][2] = reg                    # store the result directly
+                    fresh = None
+                else:
+                    for q in readers(reg):
+                        materialize(q)
+                    if name == "pop_arg":
+                        code.append([MOVI if e[0] == "k" else MOV, reg, e[1]])
+                    else:
+                        code.append([INC if name == "inc" else DEC, reg])
+                if 0 <= reg - n < len(stack):              # a var: its stack slot is its register
+                    stack[reg - n] = ("r", reg)
+            elif name == "binary":
+                b = stack.pop()
+                a = stack.pop()
+                emit_bin(binary_ops[op], a, b)
+            elif name == "binary_arg":
+                emit_bin(binary_ops[op], stack.pop(), ("r", slot(operand)))
+            elif name == "binary_immd":
+                emit_bin(binary_ops[op], stack.pop(), ("k", operand))
+            elif name == "unary":
+                a = stack.pop()
+                f = unary_ops[op]
+                if a[0] == "k":
+                    stack.append(("k", f(a[1])))
+                else:
+                    code.append([UN, f, n + len(stack), a[1]])
+                    stack.append(("r", n + len(stack)))
+            elif name == "binary_jz":
+                b = stack.pop()
+                a = stack.pop()
+                flush()
+                emit_jz(binary_ops[op], a, b, operand)
+            elif name in ["jz", "jnz"]:
+                a = stack.pop()
+                p = len(stack)
+                if name == "jz" and a == ("r", n + p) and fresh == len(code) - 1 and code[fresh][0] in [BIN, BINI]:
+                    kind, f, _, x, y = code.pop()           # compare and branch in one instruction
+                    flush()
+                    code.append([BJZ if kind == BIN else BJZI, f, x, y, operand])
+                    fresh = None
+                    continue
+                flush()
+                if a[0] == "k":
+                    if (a[1] == 0) == (name == "jz"):
+                        code.append([JMP, operand])
+                else:
+                    code.append([JZ if name == "jz" else JNZ, a[1], operand])
+            elif name == "jmp":
+                flush()
+                code.append([JMP, operand])
+            elif name == "call":
+                callee = self.index[operand]
+                n_args = self.funcs[callee].n_args
+                args = stack[len(stack) - n_args:]
+                del stack[len(stack) - n_args - 1:]        # args and the return value slot
+                d = n + len(stack)
+                code.append([CALL, callee, d, tuple((kind == "k", v) for kind, v in args)])
+                stack.append(("r", d))
+            elif name == "ret":
+                kind, v = stack.pop()
+                code.append([RETI if kind == "k" else RET, v])
+            elif name == "print_arg":
+                code.append([PRINT, slot(operand)])
+            elif name == "print_str":
+                code.append([PRINTS, operand])
+            else:
+                code.append([INVALID, opcode])
+
+        for inst in code:                                   # pc -> index in code
+            if inst[0] in _branch:
+                inst[_branch[inst[0]]] = at[inst[_branch[inst[0]]]]
+        func.code = [tuple(inst) for inst in code]
+
+    def dump(self):
+        op_names = {f: name for name, f in list(binary_ops.items()) + list(unary_ops.items())}
+        for func in self.funcs:
+            print(f"def {func.name}: args={func.n_args} regs={func.n_regs}")
+            for i, inst in enumerate(func.code):
+                args = [op_names.get(a, a) if callable(a) else a for a in inst[1:]]
+                print(f"    {i:<4} {names[inst[0]]:<8} {args}")
+
+    def run(self):
+        funcs = [(func.code, func.n_regs) for func in self.funcs]
+        main = self.funcs[self.index["main"]]
+        code = main.code
+        r = [0] * main.n_regs
+        pc = 0
+        frames = []                     # (code, pc, registers, destination) of the callers
+        print("start!")
+        while True:
+            inst = code[pc]
+            pc += 1
+            op = inst[0]
+            if op == BIN:
+                r[inst[2]] = inst[1](r[inst[3]], r[inst[4]])
+            elif op == BINI:
+                r[inst[2]] = inst[1](r[inst[3]], inst[4])
+            elif op == BJZI:
+                if inst[1](r[inst[2]], inst[3]) == 0:
+                    pc = inst[4]
+            elif op == BJZ:
+                if inst[1](r[inst[2]], r[inst[3]]) == 0:
+                    pc = inst[4]
+            elif op == MOV:
+                r[inst[1]] = r[inst[2]]
+            elif op == MOVI:
+                r[inst[1]] = inst[2]
+            elif op == JMP:
+                pc = inst[1]
+            elif op == JZ:
+                if r[inst[1]] == 0:
+                    pc = inst[2]
+            elif op == INC:
+                r[inst[1]] = wrap64(r[inst[1]] + 1)
+            elif op == CALL:
+                callee, n_regs = funcs[inst[1]]
+                if len(frames) >= self.max_depth:
+                    raise pcode.StackOverflow(f"stack overflow: more than {self.max_depth} nested calls")
+                frames.append((code, pc, r, inst[2]))
+                args = [v if imm else r[v] for imm, v in inst[3]]
+                r = args + [0] * (n_regs - len(args))
+                code = callee
+                pc = 0
+            elif op == RET or op == RETI:
+                val = r[inst[1]] if op == RET else inst[1]
+                if not frames:
+                    break
+                code, pc, r, d = frames.pop()
+                r[d] = val
+            elif op == BINK:
+                r[inst[2]] = inst[1](inst[3], r[inst[4]])
+            elif op == UN:
+                r[inst[2]] = inst[1](r[inst[3]])
+            elif op == JNZ:
+                if r[inst[1]] != 0:
+                    pc = inst[2]
+            elif op == DEC:
+                r[inst[1]] = wrap64(r[inst[1]] - 1)
+            elif op == PRINT:
+                print(f">>> {r[inst[1]]}")
+            elif op == PRINTS:
+                print(f">>> {inst[1]}")
+            else:
+                print(f"invalid opcode: {inst[1]}")
+                break
+        print("finish!")
+
+
+_known = ["push_immd", "push_arg", "pop", "pop_arg", "binary", "binary_arg", "binary_immd", "binary_jz",
+          "unary", "inc", "dec", "jz", "jnz", "jmp", "call", "ret", "print_arg", "print_str"]
+
+
+if __name__ == "__main__":
+    max_depth = [int(arg.split("=")[1]) for arg in sys.argv if arg.startswith("--max-depth=")]
+    p = RegisterProgram(pcode.Program(sys.argv[1] if len(sys.argv) > 1 and sys.argv[1][0] != "-" else "c/tinyc.asm",
+                                      max_depth=max_depth[-1] if max_depth else 10000))
+    if "--dump" in sys.argv:
+        p.dump()
+    try:
+        p.run()
+    except pcode.StackOverflow as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,362 @@
+"""
+RISC-V backend: lowers the register code of regvm.py to asm.py assembly, run by test.py
+
+the stack slots of a function are already registers r0, r1, ... in the register
+code (args, vars, then expression temporaries), here regalloc.py gives them the
+machine registers of _pool by linear scan over their live intervals; the ones
+spilled under pressure live in frame slots and go through the scratch registers
+with ld/sd:
+
+    BIN op_add, d, a, b     ->  add  d, a, b
+    BJZI cmp_lt, i, 10, L   ->  addi x3, x0, 10
+                                bge  i, x3, L
+    CALL f, d, (a, b)       ->  sd   a, 0(x2)
+                                sd   b, 8(x2)
+                                jal  x1, f_f
+                                addi d, x10, 0
+
+args are passed in the outgoing area at the bottom of the caller's frame, the
+return value in x10. a function saves the pool registers it is given, so nothing
+the caller holds in registers changes across a call. frame, from sp (x2) up:
+
+    outgoing args, spill slots, saved pool registers, x1
+
+x3 and x4 are scratch, x31 builds the addresses of far frame slots, x10 and x17
+are the ecall registers of print. functions are the tags f_<name>, main
+returning halts the program, a call that would take sp below the end of the
+image prints "stack overflow" and exits with 1
+
+    python riscv.py c/tinyc.c [-o c/tinyc.s] [--run]
+"""
+import argparse
+from ops import binary_ops, unary_ops
+from regvm import (MOV, MOVI, BIN, BINI, BINK, UN, JMP, JZ, JNZ, BJZ, BJZI,
+                   INC, DEC, CALL, RET, RETI, PRINT, PRINTS, RegisterProgram)
+import regalloc
+import pcode
+
+
+_pool = [f"x{i}" for i in [5, 6, 7, 8, 9, 11, 12, 13, 14, 15, 16] + list(range(18, 31))]
+_S1, _S2, _FAR = "x3", "x4", "x31"
+
+_op_names = {f: name for name, f in list(binary_ops.items()) + list(unary_ops.items())}
+
+# operator -> instruction, for the ones that are a single one
+_rtype = {'op_add': "add", 'op_sub': "sub", 'op_mul': "mul", 'op_div': "div", 'op_mod': "rem",
+          'op_and': "and", 'op_or': "or", 'cmp_lt': "slt"}
+_itype = {'op_add': "addi", 'op_and': "andi", 'op_or': "ori", 'cmp_lt': "slti"}
+
+# comparison -> (branch taken when it is false, operands swapped)
+_jz = {'cmp_eq': ("bne", False), 'cmp_ne': ("beq", False), 'cmp_lt': ("bge", False),
+       'cmp_ge': ("blt", False), 'cmp_gt': ("bge", True), 'cmp_le': ("blt", True)}
+_inverse = {"beq": "bne", "bne": "beq", "blt": "bge", "bge": "blt", "bltu": "bgeu", "bgeu": "bltu"}
+
+BRANCH_RANGE = 1 << 13          # B-type offsets of asm.py are imm[13:2]
+
+
+def li(reg: str, value: int) -> list:
+    """ instructions loading a 64-bit constant """
+    if -2048 <= value < 2048:
+        return [f"addi {reg}, x0, {value}"]
+    low = (value & 0xfff) - ((value & 0x800) << 1)      # sign extended low 12 bits
+    high = value - low
+    if -(1 << 31) <= high < (1 << 31):
+        code = [f"lui {reg}, {high}"]
+    else:
+        code = li(reg, high >> 12) + [f"slli {reg}, {reg}, 12"]
+    return code + ([f"addi {reg}, {reg}, {low}"] if low else [])
+
+def _words(text: str) -> str:
+    """ text in the layout of .string: a word per char and a 0 """
+    return ".word " + ", ".join(str(ord(c)) for c in text + "\0")
+
+
+class RiscvProgram:
+    def __init__(self, program: pcode.Program):
+        self.regs = RegisterProgram(program)
+        self.strings = {}               # text -> (label, address)
+        self.data_end = 4               # the strings follow the jump at 0
+        self.items = ["L_start:", "jal x1, f_main", "addi x17, x0, 10", "ecall", "L_overflow:"]
+        self.items += li("x10", self.string("stack overflow\n"))
+        self.items += ["addi x17, x0, 4", "ecall", "addi x10, x0, 1", "addi x17, x0, 93", "ecall"]
+        for i, func in enumerate(self.regs.funcs):
+            self.function(i, func)
+
+    def string(self, text: str) -> int:
+        """ address of text, the strings are laid out in the order they are asked for """
+        if text not in self.strings:
+            self.strings[text] = (f"S{len(self.strings)}", self.data_end)
+            self.data_end += 4 * (len(text) + 1)
+        return self.strings[text][1]
+
+    def function(self, index: int, func):
+        """ lines of asm, and branches as (op, rs1, rs2, label) to be relaxed by text() """
+        items = self.items
+        emit = items.append
+        code = func.code
+        hints = {inst[1]: inst[2] for inst in code if inst[0] == MOV}
+        assigned, spilled = regalloc.linear_scan(code, func.n_args, _pool, hints)
+        used = sorted(set(assigned.values()), key=_pool.index)
+        out = max([len(inst[3]) for inst in code if inst[0] == CALL], default=0)
+        spill = 8 * out                 # frame offsets
+        save = spill + 8 * len(spilled)
+        size = (save + 8 * len(used) + 8 + 15) & ~15
+        loc = [None] * func.n_regs      # machine register or frame offset, None if never live
+        for k, reg in assigned.items():
+            loc[k] = reg
+        for i, k in enumerate(spilled):
+            loc[k] = spill + 8 * i
+
+        def mem(op, reg, offset):
+            if -2048 <= offset < 2048:
+                emit(f"{op} {reg}, {offset}(x2)")
+            else:
+                items.extend(li(_FAR, offset))
+                emit(f"add {_FAR}, {_FAR}, x2")
+                emit(f"{op} {reg}, 0({_FAR})")
+
+        def src(k, scratch):
+            """ register holding r<k> """
+            if isinstance(loc[k], str):
+                return loc[k]
+            mem("ld", scratch, loc[k])
+            return scratch
+
+        def dst(k):
+            """ register to compute r<k> in, then store(k, it) """
+            return loc[k] if isinstance(loc[k], str) else _S1
+
+        def store(k, reg):
+            if isinstance(loc[k], str):
+                if loc[k] != reg:
+                    emit(f"addi {loc[k]}, {reg}, 0")
+            else:
+                mem("sd", reg, loc[k])
+
+        def imm(value, scratch):
+            """ register holding a constant """
+            if value == 0:
+                return "x0"
+            items.extend(li(scratch, value))
+            return scratch
+
+        def binop(name, rd, ra, rb):
+            if name in _rtype:
+                emit(f"{_rtype[name]} {rd}, {ra}, {rb}")
+            elif name in ['cmp_gt', 'cmp_le']:
+                emit(f"slt {rd}, {rb}, {ra}")
+            elif name == 'cmp_ge':
+                emit(f"slt {rd}, {ra}, {rb}")
+            else:
+                emit(f"sub {rd}, {ra}, {rb}")
+            if name in ['cmp_ge', 'cmp_le']:
+                emit(f"xori {rd}, {rd}, 1")
+            elif name == 'cmp_eq':
+                emit(f"sltiu {rd}, {rd}, 1")
+            elif name == 'cmp_ne':
+                emit(f"sltu {rd}, x0, {rd}")
+
+        def epilogue():
+            for i, reg in enumerate(used):
+                mem("ld", reg, save + 8 * i)
+            mem("ld", "x1", size - 8)
+            if size < 2048:
+                emit(f"addi x2, x2, {size}")
+            else:
+                items.extend(li(_S2, size))
+                emit(f"add x2, x2, {_S2}")
+            emit("jalr x0, x1, 0")
+
+        def label(target):
+            return f"L{index}_{target}"
+
+        targets = set()
+        for inst in code:
+            if inst[0] == JMP:
+                targets.add(inst[1])
+            elif inst[0] in [JZ, JNZ]:
+                targets.add(inst[2])
+            elif inst[0] in [BJZ, BJZI]:
+                targets.add(inst[4])
+
+        emit(f"# {func.name}: args={func.n_args} regs={func.n_regs} frame={size}")
+        emit(f"f_{func.name}:")
+        if size < 2048:
+            emit(f"addi x2, x2, {-size}")
+        else:
+            items.extend(li(_S1, size))
+            emit(f"sub x2, x2, {_S1}")
+        emit("@limit")                                  # x3 = end of the image
+        emit(("bltu", "x2", _S1, "L_overflow"))
+        mem("sd", "x1", size - 8)
+        for i, reg in enumerate(used):
+            mem("sd", reg, save + 8 * i)
+        for k in range(func.n_args):
+            if loc[k] is not None:
+                mem("ld", dst(k), size + 8 * k)
+                if not isinstance(loc[k], str):
+                    store(k, _S1)
+        for k in regalloc.live_on_entry(code):
+            if k >= func.n_args:                        # a var read before it is written: 0
+                store(k, "x0")
+
+        for pc, inst in enumerate(code):
+            if pc in targets:
+                emit(label(pc) + ":")
+            op = inst[0]
+            if op == MOV:
+                store(inst[1], src(inst[2], _S1))
+            elif op == MOVI:
+                rd = dst(inst[1])
+                items.extend(li(rd, inst[2]))
+                store(inst[1], rd)
+            elif op in [BIN, BINI, BINK]:
+                name = _op_names[inst[1]]
+                rd = dst(inst[2])
+                ra = imm(inst[3], _S1) if op == BINK else src(inst[3], _S1)
+                b = inst[4]
+                if op == BINI and name in _itype and -2048 <= b < 2048:
+                    emit(f"{_itype[name]} {rd}, {ra}, {b}")
+                elif op == BINI and name == 'op_sub' and -2048 < b <= 2048:
+                    emit(f"addi {rd}, {ra}, {-b}")
+                else:
+                    binop(name, rd, ra, imm(b, _S2) if op == BINI else src(b, _S2))
+                store(inst[2], rd)
+            elif op == UN:
+                rd = dst(inst[2])
+                ra = src(inst[3], _S1)
+                if _op_names[inst[1]] == 'op_not':
+                    emit(f"xori {rd}, {ra}, -1")
+                else:
+                    emit(f"sub {rd}, x0, {ra}")
+                store(inst[2], rd)
+            elif op == JMP:
+                emit(f"jal x0, {label(inst[1])}")
+            elif op in [JZ, JNZ]:
+                emit(("beq" if op == JZ else "bne", src(inst[1], _S1), "x0", label(inst[2])))
+            elif op in [BJZ, BJZI]:
+                name = _op_names[inst[1]]
+                ra = src(inst[2], _S1)
+                rb = imm(inst[3], _S2) if op == BJZI else src(inst[3], _S2)
+                if name in _jz:
+                    branch, swap = _jz[name]
+                    emit((branch, rb, ra, label(inst[4])) if swap else (branch, ra, rb, label(inst[4])))
+                else:
+                    binop(name, _S1, ra, rb)
+                    emit(("beq", _S1, "x0", label(inst[4])))
+            elif op in [INC, DEC]:
+                reg = src(inst[1], _S1)
+                emit(f"addi {reg}, {reg}, {1 if op == INC else -1}")
+                store(inst[1], reg)
+            elif op == CALL:
+                for i, (is_imm, v) in enumerate(inst[3]):
+                    mem("sd", imm(v, _S1) if is_imm else src(v, _S1), 8 * i)
+                emit(f"jal x1, f_{self.regs.funcs[inst[1]].name}")
+                store(inst[2], "x10")
+            elif op in [RET, RETI]:
+                if op == RET:
+                    emit(f"addi x10, {src(inst[1], _S1)}, 0")
+                else:
+                    items.extend(li("x10", inst[1]))
+                epilogue()
+            elif op == PRINT:
+                items.extend(li("x10", self.string(">>> ")))
+                emit("addi x17, x0, 4")
+                emit("ecall")
+                emit(f"addi x10, {src(inst[1], _S1)}, 0")
+                emit("addi x17, x0, 1")
+                emit("ecall")
+            elif op == PRINTS:
+                items.extend(li("x10", self.string(f">>> {inst[1]}\n")))
+                emit("addi x17, x0, 4")
+                emit("ecall")
+            else:
+                items.extend(li("x10", self.string(f"invalid opcode: {inst[1]}\n")))
+                emit("addi x17, x0, 4")
+                emit("ecall")
+                emit("addi x17, x0, 10")
+                emit("ecall")
+
+    def text(self) -> str:
+        """ the asm.py source; a branch too far for a B-type offset jumps over a jal """
+        items = self.items
+        far = set()
+        while True:
+            addr = self.data_end
+            pcs = []
+            where = {}
+            for i, item in enumerate(items):
+                pcs.append(addr)
+                if isinstance(item, tuple):
+                    addr += 8 if i in far else 4
+                elif item == "@limit":
+                    addr += 8
+                elif item[-1] == ":":
+                    where[item[:-1]] = addr
+                elif item[0] != "#":
+                    addr += 4
+            more = {i for i, item in enumerate(items) if isinstance(item, tuple) and i not in far
+                    and not -BRANCH_RANGE <= where[item[3]] - pcs[i] < BRANCH_RANGE}
+            if not more:
+                break
+            far |= more
+        low = (addr & 0xfff) - ((addr & 0x800) << 1)
+        limit = [f"    lui {_S1}, {addr - low}", f"    addi {_S1}, {_S1}, {low}"]
+
+        lines = ["    jal x0, L_start"]
+        for text, (name, _) in self.strings.items():
+            lines += [f"{name}:", "    " + _words(text)]
+        for i, item in enumerate(items):
+            if isinstance(item, tuple):
+                op, rs1, rs2, target = item
+                if i in far:
+                    lines += [f"    {_inverse[op]} {rs1}, {rs2}, 8", f"    jal x0, {target}"]
+                else:
+                    lines.append(f"    {op} {rs1}, {rs2}, {target}")
+            elif item == "@limit":
+                lines += limit
+            elif item[-1] == ":" or item[0] == "#":
+                lines.append(item)
+            else:
+                lines.append("    " + item)
+        return "\n".join(lines) + "\n"
+
+    def write(self, filepath: str):
+        with open(filepath, 'w', encoding='utf8') as f:
+            f.write(self.text())
+
+
+def load(filepath: str) -> pcode.Program:
+    """ a tinyc source, a pcode .asm or a .tcb """
+    if filepath.endswith(".c"):
+        import tinyc
+        gen = tinyc.GenPcode(filepath)
+        gen.gen()
+        return pcode.Program(pcodes=gen.pcodes)
+    return pcode.Program(filepath)
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import asm
+    import logs
+    import test
+
+    cli = argparse.ArgumentParser(description="compile a tinyc program to asm.py assembly")
+    cli.add_argument("file", nargs="?", default="c/tinyc.c", help=".c, pcode .asm or .tcb")
+    cli.add_argument("-o", help="output, default: the input with the extension .s")
+    cli.add_argument("--run", action="store_true", help="assemble it and run it on test.py")
+    args = cli.parse_args()
+
+    out = args.o or os.path.splitext(args.file)[0] + ".s"
+    RiscvProgram(load(args.file)).write(out)
+    if args.run:
+        binary = os.path.splitext(out)[0] + ".bin"
+        if asm.assemble(out, binary) is None:
+            sys.exit(1)
+        logs._init()
+        cpu = test.Cpu()
+        cpu.load_program(binary)
+        cpu.run()
+        sys.exit(cpu.exit_code)
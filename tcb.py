@@ -0,0 +1,153 @@
+"""
+tinyc bytecode (.tcb): a linked pcode program, loaded without any parsing
+object file (.tco): the same for one module, with relocations, linked by link.py
+
+all integers little-endian, every section 8-byte aligned
+
+    header      "<4sHHIIIIII"       magic, version, flags, n_inst, n_operand, n_string, n_tag, string_size,
+                                    n_reloc; flags: OBJECT
+    operands    n_operand x "<q"    operand table
+    code        n_inst x "<II"      (opcode, operand): opcode is a string index, operand an index
+                                    into the operand table, or NONE
+    lines       n_inst x "<i"       line in the tinyc source, 0 if unknown
+    tags        n_tag x "<II"       (string index of the name, pc)
+    relocs      n_reloc x "<II"     (pc, string index of the symbol or NONE): the operand of the
+                                    instruction at pc is a pc of this module, or a call of the symbol
+    strings     n_string x "<II"    (offset, size) into the string data
+    string data utf8                opcode names, tag names and print literals
+
+the operand of print_str is a string index, all other operands are integers;
+the tags of an object are the functions it exports
+"""
+import sys
+import mmap
+import struct
+
+
+MAGIC = b"TCB\0"
+VERSION = 1
+NONE = 0xffffffff
+OBJECT = 1
+
+header = struct.Struct("<4sHHIIIIII")
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+def _view(buf, offset: int, n: int, fmt: str):
+    """ n items of fmt at offset, without copying on little-endian hosts """
+    size = struct.calcsize(fmt)
+    mv = memoryview(buf)[offset:offset + n * size]
+    if sys.byteorder == "little":
+        return mv.cast(fmt)
+    return [i[0] for i in struct.iter_unpack("<" + fmt, mv)]
+
+
+def write(filepath: str, insts: list, lines: list, tags: dict, relocs: list = None):
+    """
+    insts: [(opcode, operand)], lines: pc -> source line or None, tags: name -> pc
+    relocs: [(pc, symbol or None)], an object file if given
+    """
+    strings = {}                    # str -> index
+    def string(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    operands = []
+    code = []
+    for opcode, operand in insts:
+        if operand is None:
+            index = NONE
+        else:
+            index = len(operands)
+            operands.append(string(operand) if opcode == "print_str" else operand)
+        code.append(string(opcode))
+        code.append(index)
+    tag_table = []
+    for name, pc in tags.items():
+        tag_table.append(string(name))
+        tag_table.append(pc)
+    reloc_table = []
+    for pc, symbol in relocs or []:
+        reloc_table.append(pc)
+        reloc_table.append(NONE if symbol is None else string(symbol))
+
+    data = [s.encode('utf8') for s in strings]
+    string_table = []
+    offset = 0
+    for s in data:
+        string_table.append(offset)
+        string_table.append(len(s))
+        offset += len(s)
+
+    sections = [
+        struct.pack(f"<{len(operands)}q", *operands),
+        struct.pack(f"<{len(code)}I", *code),
+        struct.pack(f"<{len(lines)}i", *[n or 0 for n in lines]),
+        struct.pack(f"<{len(tag_table)}I", *tag_table),
+        struct.pack(f"<{len(reloc_table)}I", *reloc_table),
+        struct.pack(f"<{len(string_table)}I", *string_table),
+        b''.join(data),
+    ]
+    with open(filepath, 'wb') as f:
+        f.write(header.pack(MAGIC, VERSION, 0 if relocs is None else OBJECT, len(insts), len(operands),
+                            len(strings), len(tags), offset, len(reloc_table) // 2))
+        for section in sections:
+            f.write(section)
+            f.write(b'\0' * (_align(len(section)) - len(section)))
+
+
+def load(filepath: str):
+    """ -> (insts, lines, tags) as given to write() """
+    insts, lines, tags, relocs = _load(filepath)
+    if relocs is not None:
+        raise ValueError(f"{filepath}: an object file, link it with link.py first")
+    return insts, lines, tags
+
+def load_object(filepath: str):
+    """ -> (insts, lines, tags, relocs) as given to write() """
+    insts, lines, tags, relocs = _load(filepath)
+    if relocs is None:
+        raise ValueError(f"{filepath}: a linked program, not an object file")
+    return insts, lines, tags, relocs
+
+def _load(filepath: str):
+    with open(filepath, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, flags, n_inst, n_operand, n_string, n_tag, string_size, n_reloc = header.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{filepath}: not a version {VERSION} tcb file")
+
+    offset = header.size
+    operands = _view(buf, offset, n_operand, "q")
+    offset += _align(n_operand * 8)
+    code = _view(buf, offset, n_inst * 2, "I")
+    offset += _align(n_inst * 8)
+    lines = _view(buf, offset, n_inst, "i")
+    offset += _align(n_inst * 4)
+    tag_table = _view(buf, offset, n_tag * 2, "I")
+    offset += _align(n_tag * 8)
+    reloc_table = _view(buf, offset, n_reloc * 2, "I")
+    offset += _align(n_reloc * 8)
+    string_table = _view(buf, offset, n_string * 2, "I")
+    offset += _align(n_string * 8)
+
+    strings = [str(buf[offset + string_table[i]:offset + string_table[i] + string_table[i + 1]], 'utf8')
+               for i in range(0, n_string * 2, 2)]
+    insts = []
+    for i in range(0, n_inst * 2, 2):
+        opcode = strings[code[i]]
+        index = code[i + 1]
+        operand = None if index == NONE else operands[index]
+        if opcode == "print_str":
+            operand = strings[operand]
+        insts.append((opcode, operand))
+    tags = {strings[tag_table[i]]: tag_table[i + 1] for i in range(0, n_tag * 2, 2)}
+    lines = [n or None for n in lines]
+    if not flags & OBJECT:
+        return insts, lines, tags, None
+    relocs = [(reloc_table[i], None if reloc_table[i + 1] == NONE else strings[reloc_table[i + 1]])
+              for i in range(0, n_reloc * 2, 2)]
+    return insts, lines, tags, relocs
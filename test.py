@@ -1,61 +1,342 @@
-import logs
+"""
+simulator of the RISC-V subset assembled by asm.py
+
+    python test.py prog.bin [--mem 1048576] [--max-step N] [--regs]
+
+the image is loaded at address 0 and runs from pc 0 with sp (x2) at the top of
+memory. every word is decoded once, the first time pc reaches it, into a closure
+that executes the instruction and returns the next pc; the closures are cached by
+pc and a store into the program drops the words it overwrites
+
+mul, div, divu, rem and remu of the M extension are there too: x / 0 = -1, x % 0 = x
+
+jal, jalr and the branches use the offsets of asm.py: imm[21:2], imm[13:2] and
+imm[13:7] + imm[6:2]
+
+ecall takes its service in a7 (x17) and its argument in a0 (x10), as in RARS:
+    1   print a0 as an integer
+    4   print the .string at a0
+    10  halt
+    11  print a0 as a char
+    93  halt with exit code a0
+ebreak and a jump to itself halt as well
+"""
 import sys
+import time
+import struct
+import operator
+import argparse
+import logs
+from ops import SIGN64, MASK64, wrap64, c_div, c_mod
+
+
+_u32 = struct.Struct("<I").unpack_from
+
+# funct3 -> unpack_from, pack_into with size and mask
+_loads = {0b000: struct.Struct("<b").unpack_from, 0b100: struct.Struct("<B").unpack_from,
+          0b010: struct.Struct("<i").unpack_from, 0b110: struct.Struct("<I").unpack_from,
+          0b011: struct.Struct("<q").unpack_from}
+_stores = {0b000: (struct.Struct("<B").pack_into, 1, 0xff),
+           0b010: (struct.Struct("<I").pack_into, 4, 0xffffffff),
+           0b011: (struct.Struct("<Q").pack_into, 8, MASK64)}
 
+def _div(a, b):
+    """ division of the M extension: truncated, x / 0 = -1 """
+    return c_div(a, b) if b else -1
 
-ISA = [
-    ['op_nop', 0],
-    ['op_ld', 2],
-    ['op_movi', 3],
-    ['op_st', 4],
-    ['op_inc', 5],
-    ['op_cmpi', 6],
-    ['op_bnz', 7],
-    ['op_halt', 8]
-]
+def _rem(a, b):
+    return c_mod(a, b) if b else a
 
-op_decode_dir = {}   # opcode -> name
-op_encode_dir = {}   # name -> opcode
-op_execute_dir = {}  
+def _divu(a, b):
+    return wrap64((a & MASK64) // (b & MASK64)) if b else -1
 
+def _remu(a, b):
+    return wrap64((a & MASK64) % (b & MASK64)) if b else a
 
-for name, i in ISA:
-    op_decode_dir[i] = name 
-    op_encode_dir[name] = i
+# (funct3, funct7) -> f(a, b) on signed 64-bit values, shared by the register and immediate forms
+_alu = {
+    (0b000, 0): lambda a, b: ((a + b + SIGN64) & MASK64) - SIGN64,
+    (0b000, 0b0100000): lambda a, b: ((a - b + SIGN64) & MASK64) - SIGN64,
+    (0b001, 0): lambda a, b: ((a << (b & 0x3f)) + SIGN64 & MASK64) - SIGN64,
+    (0b010, 0): lambda a, b: int(a < b),
+    (0b011, 0): lambda a, b: int(a & MASK64 < b & MASK64),
+    (0b100, 0): operator.xor,
+    (0b101, 0): lambda a, b: (((a & MASK64) >> (b & 0x3f)) + SIGN64 & MASK64) - SIGN64,
+    (0b101, 0b0100000): lambda a, b: a >> (b & 0x3f),
+    (0b110, 0): operator.or_,
+    (0b111, 0): operator.and_,
+    (0b000, 0b0000001): lambda a, b: wrap64(a * b),
+    (0b100, 0b0000001): _div,
+    (0b101, 0b0000001): _divu,
+    (0b110, 0b0000001): _rem,
+    (0b111, 0b0000001): _remu,
+}
 
+# funct3 -> taken(a, b)
+_branch = {
+    0b000: operator.eq,
+    0b001: operator.ne,
+    0b100: operator.lt,
+    0b101: operator.ge,
+    0b110: lambda a, b: a & MASK64 < b & MASK64,
+    0b111: lambda a, b: a & MASK64 >= b & MASK64,
+}
 
-def uint64(x): return x & ((1 << 64) - 1)
+
+def sext(x, bits): return x - (1 << bits) if x >> (bits - 1) & 1 else x
+
+def uint64(x): return x & MASK64
+
+
+class Halt(Exception):
+    """ raised by the instruction that stops the program """
+
+
+class Fault(Exception):
+    """ illegal instruction, bad address """
 
 
 class Cpu:
-    def __init__(self):
+    def __init__(self, mem_size=1 << 20):
         self.pc = 0             # program counter
-        self.reg = [0]*12       # 64-bit 2's complement
-        self.mem = bytearray(4) # memory
+        self.reg = [0]*32       # 64-bit 2's complement, x0 stays 0
+        self.mem = bytearray(mem_size)
+        self.view = memoryview(self.mem)
+        self.memsize = mem_size
+        self.code_end = 0       # stores below here may overwrite cached instructions
+        self.cache = []         # pc >> 2 -> closure, None until decoded
+        self.steps = 0          # instructions executed
+        self.exit_code = 0
 
     def load_program(self, path):
         with open(path, 'rb') as f:
-            self.mem = bytearray(f.read())
-        self.memsize = len(self.mem)
-
-    def step(self):
-        global op_decode_dir 
-        global op_execute_dir
-        if self.pc < 0 or self.pc >= self.memsize or self.pc & 3:
-            logs.error(f"invalid pc {self.pc}")
-            sys.exit(-1)
-        inst = self.mem[self.pc:self.pc+4]
-        opcode = inst[0]
-        if not opcode in op_decode_dir.keys():
-            logs.error("invalid opcode {}".format(bin(opcode)))
-            inst = bytearray(4) 
-        inst_name = op_decode_dir[inst[0]]
-        logs.error("pc = {:<10}, inst = {}".format(self.pc, inst_name))
-        op_execute_dir[inst_name](inst)      # call executor
-          
-
-    def run(self, max_step=1000):
-        for i in range(max_step):
-            self.step()
+            image = f.read()
+        if len(image) > self.memsize:
+            self.__init__(len(image) + (1 << 20))
+        self.mem[:len(image)] = image
+        self.code_end = len(image)
+        self.cache = [None] * (self.memsize >> 2)
+        self.pc = 0
+        self.reg = [0]*32
+        self.reg[2] = self.memsize
+
+    def decode(self, pc):
+        """ -> closure running the instruction at pc and returning the next pc """
+        inst = _u32(self.view, pc)[0]
+        opcode = inst & 0x7f
+        rd = inst >> 7 & 0x1f
+        funct3 = inst >> 12 & 0x7
+        rs1 = inst >> 15 & 0x1f
+        rs2 = inst >> 20 & 0x1f
+        x = self.reg
+        nxt = pc + 4
+
+        def nop():
+            return nxt
+
+        def fault(msg):
+            def f():
+                raise Fault(msg)
+            return f
+
+        if opcode == 0b0010011:                         # addi ... srai
+            imm = sext(inst >> 20, 12)
+            key = (funct3, 0)
+            if funct3 in (0b001, 0b101):
+                imm = inst >> 20 & 0x3f
+                key = (funct3, inst >> 25 & 0b1111110)
+            if key not in _alu:
+                return fault(f"illegal instruction {inst:08x}")
+            if rd == 0:
+                return nop
+            if key == (0b000, 0):
+                def f():
+                    x[rd] = ((x[rs1] + imm + SIGN64) & MASK64) - SIGN64
+                    return nxt
+                return f
+            op = _alu[key]
+            def f():
+                x[rd] = op(x[rs1], imm)
+                return nxt
+            return f
+
+        if opcode == 0b0110011:                         # add ... and, mul ... remu
+            key = (funct3, inst >> 25)
+            if key not in _alu:
+                return fault(f"illegal instruction {inst:08x}")
+            if rd == 0:
+                return nop
+            if key == (0b000, 0):
+                def f():
+                    x[rd] = ((x[rs1] + x[rs2] + SIGN64) & MASK64) - SIGN64
+                    return nxt
+                return f
+            op = _alu[key]
+            def f():
+                x[rd] = op(x[rs1], x[rs2])
+                return nxt
+            return f
+
+        if opcode in (0b0110111, 0b0010111):            # lui, auipc
+            imm = sext(inst & 0xfffff000, 32)
+            if opcode == 0b0010111:
+                imm = sext(pc + imm & MASK64, 64)
+            if rd == 0:
+                return nop
+            def f():
+                x[rd] = imm
+                return nxt
+            return f
+
+        if opcode == 0b1100011:                         # beq ... bgeu
+            offset = sext((inst >> 25 & 0x7f) << 7 | (inst >> 7 & 0x1f) << 2, 14)
+            target = pc + offset
+            if funct3 not in _branch:
+                return fault(f"illegal instruction {inst:08x}")
+            if not 0 <= target < self.memsize:
+                return fault(f"branch out of memory: {target}")
+            taken = _branch[funct3]
+            if offset == 0:
+                def f():
+                    if taken(x[rs1], x[rs2]):
+                        raise Halt
+                    return nxt
+                return f
+            def f():
+                if taken(x[rs1], x[rs2]):
+                    return target
+                return nxt
+            return f
+
+        if opcode == 0b1101111:                         # jal
+            target = pc + sext((inst >> 12) << 2, 22)
+            if not 0 <= target < self.memsize:
+                return fault(f"jump out of memory: {target}")
+            if target == pc:
+                def f():
+                    if rd:
+                        x[rd] = nxt
+                    raise Halt
+                return f
+            if rd == 0:
+                def f():
+                    return target
+                return f
+            def f():
+                x[rd] = nxt
+                return target
+            return f
+
+        if opcode == 0b1100111:                         # jalr
+            imm = sext((inst >> 20) << 2, 14)
+            def f():
+                target = (x[rs1] + imm) & ~1
+                if rd:
+                    x[rd] = nxt
+                if target & 3 or not 0 <= target < self.memsize:
+                    raise Fault(f"bad jump target: {target}")
+                return target
+            return f
+
+        if opcode == 0b0000011:                         # lb ... ld
+            if funct3 not in _loads:
+                return fault(f"illegal instruction {inst:08x}")
+            unpack = _loads[funct3]
+            imm = sext(inst >> 20, 12)
+            view = self.view
+            def f():
+                addr = x[rs1] + imm
+                if addr < 0:
+                    raise Fault(f"load from {addr}")
+                v = unpack(view, addr)[0]
+                if rd:
+                    x[rd] = v
+                return nxt
+            return f
+
+        if opcode == 0b0100011:                         # sb, sw, sd
+            if funct3 not in _stores:
+                return fault(f"illegal instruction {inst:08x}")
+            pack, size, mask = _stores[funct3]
+            imm = sext((inst >> 25) << 5 | rd, 12)
+            view = self.view
+            cache = self.cache
+            code_end = self.code_end
+            def f():
+                addr = x[rs1] + imm
+                if addr < 0:
+                    raise Fault(f"store to {addr}")
+                pack(view, addr, x[rs2] & mask)
+                if addr < code_end:                     # self-modifying code, decode again
+                    for k in range(addr >> 2, (addr + size + 3) >> 2):
+                        cache[k] = None
+                return nxt
+            return f
+
+        if inst == 0x00000073:                          # ecall
+            def f():
+                self.ecall()
+                return nxt
+            return f
+        if inst == 0x00100073:                          # ebreak
+            def f():
+                raise Halt
+            return f
+        return fault(f"illegal instruction {inst:08x}")
+
+    def ecall(self):
+        x = self.reg
+        service, a0 = x[17], x[10]
+        if service == 1:
+            print(a0)
+        elif service == 4:
+            chars = []
+            addr = a0
+            while True:
+                c = _u32(self.view, addr)[0]
+                if c == 0:
+                    break
+                if c > 0x10ffff:
+                    raise Fault(f"not a .string at {a0}")
+                chars.append(chr(c))
+                addr += 4
+            print(''.join(chars), end='')
+        elif service == 11:
+            print(chr(a0 & 0x10ffff), end='')
+        elif service == 10:
+            raise Halt
+        elif service == 93:
+            self.exit_code = a0
+            raise Halt
+        else:
+            raise Fault(f"unknown ecall {service}")
+
+    def run(self, max_step=None):
+        """ run until halt, a fault or max_step instructions; -> True if it halted """
+        cache = self.cache
+        decode = self.decode
+        pc = self.pc
+        n = 0
+        halted = False
+        start = time.perf_counter()
+        try:
+            for n in range(max_step or sys.maxsize):
+                f = cache[pc >> 2]
+                if f is None:
+                    f = cache[pc >> 2] = decode(pc)
+                pc = f()
+            n += 1
+        except Halt:
+            halted = True
+            n += 1
+        except (Fault, struct.error, IndexError) as e:
+            logs.error(f"pc = {pc}: {e}")
+            self.exit_code = -1
+        self.pc = pc
+        elapsed = time.perf_counter() - start
+        self.steps += n
+        logs.error(f"{n} instructions in {elapsed:.3f}s, {n / max(elapsed, 1e-9):,.0f} instructions/s")
+        return halted
 
     def print_regs(self):
         logs.error("---------- Registers ----------")
@@ -65,7 +346,7 @@ class Cpu:
 
     def print_one_reg(self, x):
         overflow = 'no'
-        if x >> 64:
+        if not -SIGN64 <= x <= MASK64:
             overflow = 'yes'
         # unsigned
         x = uint64(x)
@@ -80,28 +361,19 @@ class Cpu:
         logs.error("{:>3}{:>66}{:>20}{:>22}{:>22}".format(overflow, binary, hexadecimal, x, signed))
 
 
-    def op_nop(self, inst):
-        self.pc += 4
-        logs.error("nop")
-        return
-
-logs._init()
-cpu = Cpu()
-
-for name, _ in ISA:
-    if hasattr(cpu,name):
-        op_execute_dir[name] = getattr(cpu,name)
-        logs.error('[instruction] {:<10} support'.format(name))
-    else:
-        op_execute_dir[name] = getattr(cpu,'op_nop')
-        logs.error('[instruction] {:<10} not support'.format(name))
-
-cpu.load_program(sys.argv[1])
-logs.error(f'[bin] {sys.argv[1]} load, mem_size ={cpu.memsize}')
-
-cpu.run()
-
-
-
-
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="run a binary assembled by asm.py")
+    cli.add_argument("file", help="raw memory image, the output of asm.py")
+    cli.add_argument("--mem", type=int, default=1 << 20, help="memory size in bytes")
+    cli.add_argument("--max-step", type=int, help="stop after this many instructions")
+    cli.add_argument("--regs", action="store_true", help="print the registers at the end")
+    args = cli.parse_args()
 
+    logs._init()
+    cpu = Cpu(args.mem)
+    cpu.load_program(args.file)
+    logs.error(f'[bin] {args.file} load, mem_size ={cpu.memsize}')
+    cpu.run(args.max_step)
+    if args.regs:
+        cpu.print_regs()
+    sys.exit(cpu.exit_code)
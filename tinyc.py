@@ -1,31 +1,306 @@
+import io
+import os
+import sys
+import glob
+import time
+import argparse
+import contextlib
+import concurrent.futures
 import lark
-from lark import Lark
+from ops import binary_ops, unary_ops, wrap64
+from parser_cache import load_parser
+import peephole
+import pcode
+import tcb
+import build_cache
 
-_op_arith = ['op_add', 'op_sub', 'op_mul', 'op_div', 'op_mod',
-          'cmp_eq', 'cmp_ne', 'cmp_gt', 'cmp_lt', 'cmp_ge', 'cmp_le',
-          'op_and', 'op_or', 'op_not', 'op_neg']
+_op_arith = list(binary_ops) + list(unary_ops)
 
 _op = ['var', 'arg', 'push', 'pop', 'print', 'jz', 'jnz', 'jmp', 'ret']
 
-class GenPcode:
-    def __init__(self, filepath:str):
-        with open("tinyc.lark", 'r', encoding='utf-8') as f:
-            grammar = f.read()
-        tinyc_parser = Lark(grammar, start="program", lexer="standard")
+grammar_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tinyc.lark")
+
+_jump_stmt = ['returnstmt', 'breakstmt', 'continuestmt']
+
+
+def _int(s: str) -> int:
+    """ value of an INTEGER token: 14, 0xae, 0b1110; wrapped to 64 bits like the VM does """
+    if s[:2].lower() in ['0x', '0b']:
+        return wrap64(int(s, 0))
+    return wrap64(int(s))
+
+def _const(root):
+    """ value of a literal expression, None if it is not a literal """
+    if isinstance(root, lark.Tree) and root.data == "push_immd":
+        return _int(root.children[0])
+    return None
+
+
+def _literal(code: list):
+    """ value of the pcode of a literal expression, None if it is not a literal """
+    if len(code) == 1 and code[0][0].startswith("push "):
+        s = code[0][0][5:]
+        if s[0].isdigit() or s[0] == "-":
+            return _int(s)
+    return None
+
+def _declars(codes: list):
+    """ the variable declarations in a list of pcode lists """
+    return [(s, n) for code in codes for s, n in code if s.startswith("var ")]
+
+
+def get_parser(earley=False, transformer=None):
+    """ 
+    LALR(1) with a contextual lexer, or the slower Earley parser as a fallback
+    transformer is called inline while parsing (LALR only)
+    """
+    with open(grammar_path, 'r', encoding='utf-8') as f:
+        grammar = f.read()
+    if earley:
+        return load_parser("tinyc", grammar, start="program", lexer="standard")
+    return load_parser("tinyc", grammar, transformer, start="program", parser="lalr", lexer="contextual")
+
+
+class FoldConstants(lark.Transformer):
+    """ 
+    AST optimization before code generation:
+        fold expressions of literals through the operator table
+        keep only the taken branch of if/while with a literal condition
+        drop statements after return/break/continue
+    variable declarations in dropped code are kept, they are function wide
+    """
+    def __default__(self, data, children, meta):
+        if data in binary_ops or data in unary_ops:
+            values = [_const(i) for i in children]
+            if None not in values:
+                try:
+                    if data in binary_ops:
+                        value = binary_ops[data](*values)
+                    else:
+                        value = unary_ops[data](*values)
+                except ZeroDivisionError:       # leave it to runtime
+                    return lark.Tree(data, children, meta)
+                token = lark.Token.new_borrow_pos("INTEGER", str(value), children[0].children[0])
+                return lark.Tree("push_immd", [token], meta)
+        return lark.Tree(data, children, meta)
+
+    def _declars(self, roots: list):
+        return [declar for root in roots for declar in root.find_data("var_declar")]
+
+    def stmtblock(self, children):
+        stmts = []
+        for i, stmt in enumerate(children):
+            stmts.append(stmt)
+            if stmt.data in _jump_stmt:
+                stmts.extend(self._declars(children[i+1:]))
+                break
+        return lark.Tree("stmtblock", stmts)
+
+    def ifstmt(self, children):
+        cond = _const(children[0])
+        if cond is None:
+            return lark.Tree("ifstmt", children)
+        taken = children[1] if cond else lark.Tree("stmtblock", children[2:])
+        dropped = children[2:] if cond else [children[1]]
+        return lark.Tree("stmtblock", taken.children + self._declars(dropped))
+
+    def whilestmt(self, children):
+        if _const(children[0]) == 0:
+            return lark.Tree("stmtblock", self._declars(children[1:]))
+        return lark.Tree("whilestmt", children)
+
+    def expr_stmt(self, children):
+        if _const(children[0]) is not None:
+            return lark.Tree("stmtblock", [])
+        return lark.Tree("expr_stmt", children)
+
+# break/continue before the enclosing loop is reduced
+_BREAK = "jmp \0break"
+_CONTINUE = "jmp \0continue"
+
+class SinglePassGen(lark.Transformer):
+    """
+    code generation while parsing, the inline transformer of the LALR parser
+    every rule returns its pcode as a list of (pcode, line); a function is passed 
+    to GenPcode._pcode as soon as it is reduced, no tree is kept.
+    with optimize it folds like FoldConstants
+    """
+    def __init__(self, gen, optimize=False):
+        super().__init__()
+        self.gen = gen 
+        self.optimize = optimize
+
+    def __getattr__(self, name):
+        if name in _op_arith:
+            return lambda children: self._op(name, children)
+        raise AttributeError(name)
+
+    def program(self, children):
+        return None
+
+    def function(self, children):
+        _, name, args, body = children
+        self.gen._pcode(f"def {name}:", name.line)
+        for token in args:
+            self.gen._pcode(f"arg {token}", token.line)
+        for s, n in body:
+            if s in [_BREAK, _CONTINUE]:
+                print("[error] break/continue outside a loop, line", name.line)
+            else:
+                self.gen._pcode(s, n)
+
+    def func_args(self, children):
+        return children
+
+    def func_arg(self, children):
+        return children[1]
+
+    def stmtblock(self, children):
+        code = []
+        for i, stmt in enumerate(children):
+            code += stmt
+            if self.optimize and stmt and stmt[-1][0] in ["ret\n", _BREAK, _CONTINUE]:
+                code += _declars(children[i+1:])
+                break
+        return code
+
+    def var_declar(self, children):
+        token = children[1]
+        return [(f"var {token}", token.line)]
+
+    def assignstmt(self, children):
+        token, expr = children
+        return expr + [(f"pop {token}", token.line)]
+
+    def expr_stmt(self, children):
+        if self.optimize and _literal(children[0]) is not None:
+            return []
+        return children[0] + [("pop", None)]
+
+    def returnstmt(self, children):
+        return children[0] + [("ret\n", None)]
+
+    def printstmt(self, children):
+        token = children[0]
+        return [(f"print {token}", token.line)]
+
+    def breakstmt(self, children):
+        return [(_BREAK, None)]
 
+    def continuestmt(self, children):
+        return [(_CONTINUE, None)]
+
+    def ifstmt(self, children):
+        cond, body = children[:2]
+        other = children[2] if len(children) > 2 else []
+        if self.optimize and _literal(cond) is not None:
+            if _literal(cond):
+                return body + _declars([other])
+            return other + _declars([body])
+        curr_tag = self.gen.tag 
+        self.gen.tag += 1
+        return ([(f"_if_{curr_tag}", None)] + cond + [(f"jz _else_{curr_tag}", None)] + body + 
+                [(f"jmp _endif_{curr_tag}", None), (f"_else_{curr_tag}", None)] + other + 
+                [(f"_endif_{curr_tag}", None)])
+
+    def whilestmt(self, children):
+        cond, body = children
+        if self.optimize and _literal(cond) == 0:
+            return _declars([body])
+        curr_tag = self.gen.tag 
+        self.gen.tag += 1 
+        begin = f"_loop_{curr_tag}"
+        end = f"_endloop_{curr_tag}"
+        jumps = {_BREAK: f"jmp {end}", _CONTINUE: f"jmp {begin}"}
+        body = [(jumps.get(s, s), n) for s, n in body]
+        return [(begin, None)] + cond + [(f"jz {end}", None)] + body + [(f"jmp {begin}", None), (end, None)]
+
+    def push_immd(self, children):
+        token = children[0]
+        return [(f"push {token}", token.line)]
+
+    push_var = push_immd
+
+    def callexpr(self, children):
+        token = children[0]
+        code = [("push 0", None)]                   # push ret value
+        for arg in children[1:]:                    # push args
+            code += arg
+        return code + [(f"@{token}", token.line)]
+
+    def _op(self, opcode, children):
+        if self.optimize:
+            values = [_literal(i) for i in children]
+            if None not in values:
+                f = binary_ops[opcode] if opcode in binary_ops else unary_ops[opcode]
+                try:
+                    return [(f"push {f(*values)}", children[0][0][1])]
+                except ZeroDivisionError:           # leave it to runtime
+                    pass
+        code = []
+        for child in children:
+            code += child
+        return code + [(opcode, None)]
+
+
+class GenPcode:
+    def __init__(self, filepath:str, earley=False, single_pass=False, verbose=0):
+        """ 
+        single_pass: generate the pcode while parsing, in gen(), instead of parsing to a tree now 
+        verbose:     0: compact .asm   1: aligned line comments   2: also echo every instruction
+        """
         with open(filepath, "r", encoding="utf8") as f:
             text = f.read()
-        self.tree = tinyc_parser.parse(text)    # root = program
-        self.pcodes = []                        # list of pcodes
+        if single_pass and earley:
+            raise ValueError("single pass code generation needs the LALR parser")
+        self.text = text if single_pass else None
+        self.tree = None if single_pass else get_parser(earley).parse(text)  # root = program
+        self.pcodes = []                        # list of (pcode, line)
+        self.out = None                         # file the pcodes are streamed to, instead of self.pcodes
+        self.verbose = verbose
         self.tag = 0                            # loop_0, loop_1, ...
         self.loop_tags = []                     # [(loop_0, endloop_0),...]
 
-    def gen(self, filepath:str):
-        for func in self.tree.children:
-            self.function(func)
-        with open(filepath, 'w+', encoding='utf-8') as f:
-            for line in self.pcodes:
-                f.write(line+'\n')
+    def gen(self, filepath:str = None, optimize=False):
+        """ 
+        write the pcode to filepath, .asm text, .tcb bytecode or a .tco object of one module for link.py;
+        without a filepath only self.pcodes is filled
+        unless it has to be optimized or linked, .asm text is streamed to a buffered file as it is generated
+        """
+        stream = filepath is not None and not optimize and not filepath.endswith((".tcb", ".tco"))
+        if stream:
+            self.out = open(filepath, 'w', encoding='utf-8', buffering=1 << 16)
+        try:
+            if self.tree is None:
+                get_parser(transformer=SinglePassGen(self, optimize)).parse(self.text)
+                self.text = None
+            else:
+                if optimize:
+                    self.tree = FoldConstants().transform(self.tree)
+                for func in self.tree.children:
+                    self.function(func)
+        finally:
+            if stream:
+                self.out.close()
+                self.out = None
+        if stream or filepath is None and not optimize:
+            return
+        if optimize:
+            self.pcodes, report = peephole.optimize(self.pcodes)
+            for rule, removed in report.items():
+                print(f"[peephole] {rule:<16} -{removed}")
+        if filepath is None:
+            return
+        if filepath.endswith(".tcb"):                   # linked bytecode
+            program = pcode.Program(pcodes=self.pcodes)
+            tcb.write(filepath, program.insts, program.lines, program.tags)
+            return
+        if filepath.endswith(".tco"):                   # calls of other modules are relocations
+            program = pcode.Program(pcodes=self.pcodes, relocatable=True)
+            tcb.write(filepath, program.insts, program.lines, program.exports(), program.relocations())
+            return
+        with open(filepath, 'w', encoding='utf-8', buffering=1 << 16) as f:
+            f.writelines(self._format(s, n)+'\n' for s, n in self.pcodes)
         
 
     def function(self, root: lark.Tree):
@@ -125,19 +400,174 @@ class GenPcode:
             print("[error] no such rule", root.data)
 
     def _pcode(self, s: str, n = None):
+        if self.out is None:
+            self.pcodes.append((s, n))
+        else:
+            self.out.write(self._format(s, n) + '\n')
+        if self.verbose > 1:
+            print(self._format(s, n))
+
+    def _format(self, s: str, n = None):
         if s[-1] != ":":
             if s[0] != "_":
                 s = '        ' + s
         extra = "" if not n else f" // line: {n}"
-        self.pcodes.append("{:<40}".format(s) + extra)
-        print(self.pcodes[-1])
+        if self.verbose:
+            return "{:<40}".format(s) + extra
+        return s + extra
 
     def print_tree(self):
         print(self.tree.pretty())
 
 
 
+# the modules that parse or end up in the output, their hash and the lark version are the compiler
+# version of the build cache
+_compiler_files = ["tinyc.py", "peephole.py", "pcode.py", "ops.py", "tcb.py", "parser_cache.py"]
+_version = None
+_cache = None                                           # BuildCache of this process
+
+def compiler_version() -> str:
+    global _version
+    if _version is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        parts = [lark.__version__]
+        for name in _compiler_files:
+            with open(os.path.join(here, name), 'rb') as f:
+                parts.append(f.read())
+        _version = build_cache.digest(*parts)
+    return _version
+
+def build_key(path: str, ext: str, optimize=False, verbose=0, earley=False, single_pass=False) -> str:
+    """ hash of the source, the grammar, the compiler and the options of GenPcode """
+    with open(path, 'rb') as f:
+        source = f.read()
+    with open(grammar_path, 'rb') as f:
+        grammar = f.read()
+    return build_cache.digest(source, grammar, compiler_version(), repr((ext, bool(optimize), verbose, bool(earley), bool(single_pass))))
+
+def _init_worker(earley=False, single_pass=False, cache_dir="", max_bytes=build_cache.MAX_BYTES):
+    """ build the parser once per worker process, every GenPcode of the worker takes it from parser_cache """
+    global _cache
+    _cache = build_cache.BuildCache(cache_dir, max_bytes)
+    if single_pass:
+        get_parser(transformer=lark.Transformer())      # keeps the serialized parser that is copied per file
+    else:
+        get_parser(earley)
+
+def _compile_job(job: tuple) -> tuple:
+    """ (path, out, optimize, options, key) -> (path, out, seconds, ok, printed, cached) """
+    path, out, optimize, options, key = job
+    buf = io.StringIO()
+    t = time.perf_counter()
+    gen = None
+    with contextlib.redirect_stdout(buf):
+        try:
+            gen = GenPcode(path, **options)
+            gen.gen(out, optimize=optimize)
+        except Exception as e:
+            print(f"[error] {type(e).__name__}: {e}")
+    printed = buf.getvalue()
+    ok = not any(line.startswith("[error]") for line in printed.splitlines())
+    if not ok and out and os.path.exists(out):          # no half written output
+        os.remove(out)
+    if ok and key:
+        if out.endswith((".tcb", ".tco")):
+            pcodes = [s for s, n in gen.pcodes]
+        else:
+            with open(out, 'r', encoding='utf8') as f:
+                pcodes = f.read().split("\n")
+        _cache.put(key, os.path.splitext(out)[1], out, {
+            "source": path, "size": os.path.getsize(out), "functions": build_cache.function_hashes(pcodes)})
+    return path, out, time.perf_counter() - t, ok, printed, False
+
+def output_path(path: str, outdir: str = None, ext: str = ".asm") -> str:
+    out = os.path.splitext(path)[0] + ext
+    return os.path.join(outdir, os.path.basename(out)) if outdir else out
+
+def compile_many(paths: list, jobs: int = None, outdir: str = None, ext: str = ".asm", optimize=False,
+                 cache_dir: str = build_cache.cache_dir, max_bytes: int = build_cache.MAX_BYTES, **options) -> list:
+    """
+    compile every file on a pool of jobs processes, each one has its own GenPcode
+    files found in the build cache are copied out of it here, the pool only gets the others
+    -> [(path, out, seconds, ok, printed, cached)] in the order of paths
+    cache_dir "" disables the cache
+    """
+    cache = build_cache.BuildCache(cache_dir, max_bytes)
+    results = [None] * len(paths)
+    work = []
+    for i, path in enumerate(paths):
+        out = output_path(path, outdir, ext)
+        t = time.perf_counter()
+        try:
+            key = build_key(path, ext, optimize, **options) if cache_dir else None
+        except OSError:                                 # the job reports it
+            key = None
+        if key and cache.get(key, ext, out):
+            results[i] = (path, out, time.perf_counter() - t, True, "", True)
+        else:
+            work.append((i, (path, out, optimize, options, key)))
+
+    init = (options.get("earley", False), options.get("single_pass", False), cache_dir, max_bytes)
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(work) < 2:
+        if work:
+            _init_worker(*init)
+        done = [_compile_job(job) for _, job in work]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(work)), initializer=_init_worker,
+                                                    initargs=init) as pool:
+            done = list(pool.map(_compile_job, [job for _, job in work],
+                                 chunksize=max(1, len(work) // (jobs * 8))))
+    for (i, _), result in zip(work, done):
+        results[i] = result
+    if work and cache_dir:
+        cache.evict()
+    return results
+
+def expand(patterns: list) -> list:
+    """ files and globs -> files, without duplicates; a pattern that matches nothing is kept as is """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else []
+        paths += matches or [pattern]
+    return list(dict.fromkeys(paths))
+
+
 if __name__ == '__main__':
+    cli = argparse.ArgumentParser(description="compile tinyc files to pcode, in parallel")
+    cli.add_argument("files", nargs="*", default=["c/tinyc.c"], help="files or globs, \"c/**/*.c\"")
+    cli.add_argument("-j", "--jobs", type=int, help="worker processes, default: one per core")
+    cli.add_argument("-o", "--outdir", help="write the output here instead of next to each file")
+    cli.add_argument("--tcb", action="store_true", help="write linked .tcb bytecode instead of .asm")
+    cli.add_argument("-c", action="store_true", help="write a .tco object per file, linked by link.py")
+    cli.add_argument("-O", action="store_true", help="fold constants and run the peephole optimizer")
+    cli.add_argument("--earley", action="store_true", help="use the Earley parser")
+    cli.add_argument("--single-pass", action="store_true", help="generate the pcode while parsing")
+    cli.add_argument("-v", action="count", default=0, help="-v: aligned line comments, -vv: echo the pcode")
+    cli.add_argument("--no-cache", action="store_true", help="compile every file, do not use the build cache")
+    cli.add_argument("--cache-size", type=int, default=build_cache.MAX_BYTES >> 20, help="MiB the build cache keeps")
+    args = cli.parse_args()
 
-    tree = GenPcode("c/tinyc.c")
-    tree.gen("c/tinyc.asm")
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+    paths = expand(args.files)
+    start = time.perf_counter()
+    ext = ".tco" if args.c else ".tcb" if args.tcb else ".asm"
+    results = compile_many(paths, args.jobs, args.outdir, ext, optimize=args.O,
+                           cache_dir="" if args.no_cache else build_cache.cache_dir, max_bytes=args.cache_size << 20,
+                           earley=args.earley, single_pass=args.single_pass, verbose=args.v)
+    failed = 0
+    for path, out, seconds, ok, printed, cached in results:
+        if ok:
+            print(f"{seconds:8.3f}s  {path} -> {out}{' (cached)' if cached else ''}")
+        else:
+            print(f"{seconds:8.3f}s  {path} FAILED")
+        for line in printed.splitlines():
+            print("          " + line)
+        failed += not ok
+    total = sum(r[2] for r in results)
+    cached = sum(r[5] for r in results)
+    print(f"{len(results)} files, {cached} cached, {failed} failed, "
+          f"{time.perf_counter() - start:.3f}s ({total:.3f}s compiling)")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,162 @@
+"""
+execution tracer for the pcode VM
+
+runs a Program in its own dispatch loop and records every traced instruction,
+before it executes, into a ring buffer of int64 records:
+
+    pc, instruction, top of stack, ebp      instruction: index into the text table
+
+only the last `size` records are kept, so a long run costs a fixed amount of
+memory. tracing can be limited to functions or to a pc range. save() writes the
+buffer to a .tct file, dump() prints one offline
+
+    .tct    header "<4sHHIIQ"   magic, version, 0, n_text, n_records, records traced in total
+            records             n_records x 4 x "<q", oldest first
+            texts               n_text utf8 strings, "\\0" separated
+
+    python tracer.py run c/tinyc.asm [--func factor] [--pc 10 40] [--size 65536] [-o trace.tct]
+    python tracer.py dump trace.tct [--last 100]
+"""
+import sys
+import array
+import struct
+import argparse
+import pcode
+
+
+MAGIC = b"TCT\0"
+VERSION = 1
+
+header = struct.Struct("<4sHHIIQ")
+FIELDS = 4
+
+
+class Tracer:
+    def __init__(self, program: pcode.Program, size: int = 65536, funcs: list = None, pcs: tuple = None):
+        """ trace pcs in the functions named in funcs and in the range pcs = (first, last) """
+        self.program = program
+        self.size = size
+        self.buf = array.array('q', bytes(8 * FIELDS * size))
+        self.total = 0                                  # records written, including overwritten ones
+        self.texts = []
+        index = {}
+        self.inst = []                                  # pc -> index into texts
+        for opcode, operand in program.insts:
+            text = opcode if operand is None else f"{opcode} {operand}"
+            if text not in index:
+                index[text] = len(self.texts)
+                self.texts.append(text)
+            self.inst.append(index[text])
+
+        n = len(program.insts)
+        self.traced = bytearray(n)                      # pc -> 1 if traced
+        if funcs is None and pcs is None:
+            self.traced = bytearray(b"\1" * n)
+        starts = sorted((pc, name) for name, pc in program.tags.items() if name[0] != "_")
+        for i, (start, name) in enumerate(starts):
+            if funcs and name in funcs:
+                end = starts[i + 1][0] if i + 1 < len(starts) else n
+                self.traced[start:end] = b"\1" * (end - start)
+        if pcs:
+            first, last = pcs
+            self.traced[first:last + 1] = b"\1" * (min(last, n - 1) - first + 1)
+
+    def run(self):
+        p = self.program
+        code = p.code
+        buf = self.buf
+        size = self.size
+        traced = self.traced
+        inst = self.inst
+        total = 0
+        p.stack = [-1, 0, -1]
+        p.ebp = 3
+        p.depth = 0
+        p.pc = p.tags["main"]
+        print("start!")
+        try:
+            while p.pc >= 0:
+                pc = p.pc
+                if traced[pc]:
+                    i = total % size * FIELDS
+                    buf[i] = pc
+                    buf[i + 1] = inst[pc]
+                    buf[i + 2] = p.stack[-1]
+                    buf[i + 3] = p.ebp
+                    total += 1
+                handler, operand = code[pc]
+                p.pc = pc + 1
+                handler(operand)
+        finally:                                        # keep the records of a crashed run
+            self.total = total
+        print("finish!")
+
+    def records(self) -> list:
+        """ [(seq, pc, inst, tos, ebp)], oldest first """
+        n = min(self.total, self.size)
+        first = self.total - n
+        out = []
+        for seq in range(first, self.total):
+            i = seq % self.size * FIELDS
+            out.append((seq, *self.buf[i:i + FIELDS]))
+        return out
+
+    def save(self, filepath: str):
+        records = self.records()
+        data = array.array('q', [x for r in records for x in r[1:]])
+        if sys.byteorder != "little":
+            data.byteswap()
+        with open(filepath, 'wb') as f:
+            f.write(header.pack(MAGIC, VERSION, 0, len(self.texts), len(records), self.total))
+            f.write(data.tobytes())
+            f.write("\0".join(self.texts).encode('utf8'))
+
+
+def load(filepath: str):
+    """ -> (records, texts) as in Tracer.records() and Tracer.texts """
+    with open(filepath, 'rb') as f:
+        buf = f.read()
+    magic, version, _, n_text, n_records, total = header.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{filepath}: not a version {VERSION} trace file")
+    offset = header.size
+    data = array.array('q', buf[offset:offset + n_records * FIELDS * 8])
+    if sys.byteorder != "little":
+        data.byteswap()
+    texts = str(buf[offset + n_records * FIELDS * 8:], 'utf8').split("\0")
+    first = total - n_records
+    records = [(first + k, *data[k * FIELDS:(k + 1) * FIELDS]) for k in range(n_records)]
+    return records, texts
+
+def dump(filepath: str, last: int = None):
+    records, texts = load(filepath)
+    if last is not None:
+        records = records[-last:]
+    for seq, pc, inst, tos, ebp in records:
+        print("{:>10}  pc={:<6} ebp={:<6} tos={:<20} {}".format(seq, pc, ebp, tos, texts[inst]))
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="trace a pcode program, or print a saved trace")
+    sub = cli.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("run", help="run a program and save the last records")
+    p.add_argument("file", nargs="?", default="c/tinyc.asm", help=".asm or .tcb")
+    p.add_argument("--func", nargs="+", help="trace only these functions")
+    p.add_argument("--pc", type=int, nargs=2, metavar=("FIRST", "LAST"), help="trace only this pc range")
+    p.add_argument("--size", type=int, default=65536, help="records kept")
+    p.add_argument("-o", default="trace.tct", help="output file")
+    p = sub.add_parser("dump", help="print a saved trace")
+    p.add_argument("file")
+    p.add_argument("--last", type=int, help="only the newest records")
+    args = cli.parse_args()
+
+    if args.cmd == "run":
+        tracer = Tracer(pcode.Program(args.file), args.size, args.func, args.pc)
+        try:
+            tracer.run()
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+        tracer.save(args.o)
+        print(f"{min(tracer.total, tracer.size)} of {tracer.total} records -> {args.o}")
+    elif args.cmd == "dump":
+        dump(args.file, args.last)